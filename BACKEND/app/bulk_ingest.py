@@ -0,0 +1,170 @@
+"""
+Offline bulk loader for USFM files.
+
+Walks a directory with one sub-folder per project, parses the books in a pool of worker
+processes with the same normalization and parsing code as /upload_usfm/, and loads the
+verses with COPY. Books whose usfm_sha (SHA-256 of the file) is already stored for the
+project are skipped, so an interrupted load can simply be run again.
+
+    python bulk_ingest.py /data/usfm --workers 8
+"""
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+from multiprocessing import Pool
+from fastapi import HTTPException
+from database import SessionLocal, init_db
+from db_models import Project, Book, Verse
+import crud
+import ingest
+import corpus_stats
+
+
+USFM_EXTENSIONS = (".usfm", ".sfm")
+
+
+def find_usfm_files(root, projects=None):
+    """ (project_name, path) for every USFM file, taking the project name from the top-level folder """
+    tasks = []
+    for project_name in sorted(os.listdir(root)):
+        project_dir = os.path.join(root, project_name)
+        if not os.path.isdir(project_dir) or (projects and project_name not in projects):
+            continue
+        for dirpath, _, filenames in os.walk(project_dir):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(USFM_EXTENSIONS):
+                    tasks.append((project_name, os.path.join(dirpath, filename)))
+    return tasks
+
+
+def file_sha(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def prepare_book(task):
+    """ Worker: decode, normalize and parse one file. Runs in a child process without DB access. """
+    project_name, path, usfm_sha = task
+    try:
+        with open(path, "rb") as f:
+            usfm = f.read().decode("utf-8")
+        usfm = ingest.normalize_usfm(usfm, "bulk", project_name)
+        book_name = ingest.extract_book_name(usfm)
+        usj_data, parsing_errors = ingest.parse_usj(usfm, "bulk", book_name)
+        verse_rows = []
+        if not parsing_errors:
+            verse_rows = list(crud.valid_verse_rows(book_name, ingest.extract_verse_rows(usj_data, book_name)))
+        return {
+            "project_name": project_name, "path": path, "usfm_sha": usfm_sha, "book_name": book_name,
+            "usfm": usfm, "usj": usj_data, "errors": parsing_errors, "verse_rows": verse_rows,
+        }
+    except HTTPException as e:
+        return {"project_name": project_name, "path": path, "failure": str(e.detail)}
+    except Exception as e:
+        return {"project_name": project_name, "path": path, "failure": str(e)}
+
+
+def get_or_create_project(session, project_name):
+    project = session.query(Project).filter(Project.project_name == project_name).first()
+    if not project:
+        project = Project(project_name=project_name)
+        session.add(project)
+        session.commit()
+        logging.info(f"Created project {project_name} (Project ID: {project.project_id})")
+    return project.project_id
+
+
+def load_book(session, project_id, result):
+    """ Insert or replace one prepared book and COPY its verses, in a single transaction """
+    book_name = result["book_name"]
+    parsing_errors = result["errors"]
+    book = session.query(Book).filter_by(book_name=book_name, project_id=project_id).first()
+    removed_texts = []
+    if book:
+        removed_texts = [text for (text,) in session.query(Verse.text).filter(Verse.book_id == book.book_id)]
+        session.query(Verse).filter(Verse.book_id == book.book_id).delete()
+    else:
+        book = Book(book_name=book_name, project_id=project_id)
+        session.add(book)
+    book.usfm = result["usfm"]
+    book.usj = result["usj"] if not parsing_errors else None
+    book.usfm_sha = result["usfm_sha"]
+    book.status = "success" if not parsing_errors else json.dumps(parsing_errors)
+    session.flush()
+
+    verse_rows = result["verse_rows"]
+    if verse_rows:
+        crud.copy_verses(session, book.book_id, verse_rows)
+    corpus_stats.apply_verse_delta(session, book.book_id, project_id, removed_texts, [text for _, _, text in verse_rows])
+    session.commit()
+    return book.book_id
+
+
+def run(root, workers, projects=None):
+    tasks = find_usfm_files(root, projects)
+    logging.info(f"Found {len(tasks)} USFM files under {root}")
+    summary = {"loaded": 0, "skipped": 0, "failed": 0}
+
+    # Fork the workers before the first DB connection so no child inherits a connection
+    with Pool(processes=workers) as pool:
+        init_db()
+        session = SessionLocal()
+        try:
+            project_ids = {}
+            loaded_shas = {}
+            pending = []
+            for project_name, path in tasks:
+                if project_name not in project_ids:
+                    project_id = get_or_create_project(session, project_name)
+                    project_ids[project_name] = project_id
+                    loaded_shas[project_name] = {sha for (sha,) in session.query(Book.usfm_sha).filter(Book.project_id == project_id)}
+                usfm_sha = file_sha(path)
+                # Resume: books already stored from the same file content are not parsed again
+                if usfm_sha in loaded_shas[project_name]:
+                    summary["skipped"] += 1
+                    continue
+                pending.append((project_name, path, usfm_sha))
+            session.commit()
+
+            logging.info(f"Parsing {len(pending)} books with {workers} workers ({summary['skipped']} already loaded)")
+            for result in pool.imap_unordered(prepare_book, pending):
+                if "failure" in result:
+                    summary["failed"] += 1
+                    logging.error(f"Failed to process {result['path']}: {result['failure']}")
+                    continue
+                try:
+                    book_id = load_book(session, project_ids[result["project_name"]], result)
+                except Exception as e:
+                    session.rollback()
+                    summary["failed"] += 1
+                    logging.error(f"Failed to load {result['path']}: {str(e)}")
+                    continue
+                if result["errors"]:
+                    summary["failed"] += 1
+                    logging.error(f"USFM parsing failed for {result['path']}, stored with errors (Book ID: {book_id})")
+                else:
+                    summary["loaded"] += 1
+                    logging.info(f"Loaded {result['project_name']}/{result['book_name']} with {len(result['verse_rows'])} verses (Book ID: {book_id})")
+        finally:
+            session.close()
+    logging.info(f"Bulk ingest finished: {summary}")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk load a directory tree of USFM files, one folder per project")
+    parser.add_argument("root", help="directory containing one sub-folder of USFM files per project")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parser processes (default: CPU count)")
+    parser.add_argument("--project", action="append", dest="projects", help="only load this project folder (repeatable)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    summary = run(args.root, args.workers, args.projects)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
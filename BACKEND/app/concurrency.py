@@ -0,0 +1,151 @@
+import os
+import shutil
+import asyncio
+import logging
+from fastapi import HTTPException
+from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+from metrics import HEAVY_REQUESTS, HEAVY_RUNNING, HEAVY_QUEUED
+
+
+# Per endpoint and per server process; each process may open database.WORKER_CONNECTIONS DB connections
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", "2"))
+EXPORT_QUEUE_LIMIT = int(os.environ.get("EXPORT_QUEUE_LIMIT", "8"))
+RETRY_AFTER_SECONDS = int(os.environ.get("EXPORT_RETRY_AFTER", "10"))
+
+
+def request_key(request):
+    """ Identity of a request for coalescing: path and query parameters, in any order """
+    return (request.url.path, tuple(sorted(request.query_params.multi_items())))
+
+
+class SharedFile:
+    """
+    A file result of a computation, alone in a temporary directory, for example an export archive.
+    Coalesced requests share the path rather than the content: each one sends the file as its
+    own FileResponse, and the directory is removed once the last of them is done with it.
+    References are only taken and dropped on the event loop.
+    """
+    def __init__(self, path, directory, media_type=None, filename=None, headers=None):
+        self.path = path
+        self.directory = directory
+        self.media_type = media_type
+        self.filename = filename
+        self.headers = headers
+        # Held by HeavyEndpoint until no request is left waiting for the computation
+        self._refs = 1
+
+    def response(self):
+        self._refs += 1
+        return _SharedFileResponse(self)
+
+    def release(self):
+        self._refs -= 1
+        if self._refs == 0:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class _SharedFileResponse(FileResponse):
+    def __init__(self, shared):
+        super().__init__(shared.path, media_type=shared.media_type, filename=shared.filename, headers=shared.headers)
+        self._shared = shared
+
+    async def __call__(self, scope, receive, send):
+        # Also when the client goes away mid-transfer, which skips background tasks
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._shared.release()
+
+
+class HeavyEndpoint:
+    """
+    Admission control for an expensive endpoint:
+    - identical requests in flight share one computation and its response (single flight);
+    - at most `limit` computations run at once and up to `max_queue` more wait for a slot;
+    - beyond that a request is rejected with 429 and a Retry-After header.
+    The computation is a blocking function run in the threadpool, so queued requests and the
+    cheap endpoints keep the event loop. It returns a response shared as is, or a SharedFile
+    that every request sends as its own response.
+    """
+    def __init__(self, name, limit=EXPORT_CONCURRENCY, max_queue=EXPORT_QUEUE_LIMIT):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self._semaphore = None
+        self._queued = 0
+        self._running = 0
+        self._in_flight = {}
+        self._waiting = {}
+
+    async def run(self, key, func, *args):
+        task = self._in_flight.get(key)
+        if task is not None:
+            HEAVY_REQUESTS.labels(self.name, "coalesced").inc()
+            logging.info(f"Coalesced {self.name} request with an identical one in flight")
+        else:
+            self._admit()
+            # The computation is its own task: it holds the slot until the thread is done, and a
+            # request that goes away (the first one included) cancels only its own wait
+            task = asyncio.ensure_future(self._run_limited(func, *args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+
+        self._waiting[task] = self._waiting.get(task, 0) + 1
+        try:
+            result = await asyncio.shield(task)
+            return result.response() if isinstance(result, SharedFile) else result
+        finally:
+            self._waiting[task] -= 1
+            if not self._waiting[task]:
+                del self._waiting[task]
+                if task.done():
+                    self._release(task)
+
+    def _finished(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here, so an error nobody waited for any more is not logged as unhandled
+        # Every request went away before the computation was done
+        if task not in self._waiting:
+            self._release(task)
+
+    @staticmethod
+    def _release(task):
+        """ Drop the computation's own reference to a SharedFile result, once every waiting request has taken one """
+        if not task.cancelled() and task.exception() is None and isinstance(task.result(), SharedFile):
+            task.result().release()
+
+    def _admit(self):
+        """ Take a queue place for a new computation, or reject the request with 429 """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        # Counted here rather than from the semaphore: an admitted task only acquires it once it starts
+        if self._running + self._queued >= self.limit + self.max_queue:
+            HEAVY_REQUESTS.labels(self.name, "rejected").inc()
+            logging.warning(f"Rejected {self.name} request: {self._running} running and {self._queued} queued")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many {self.name} requests in progress, retry later",
+                headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+            )
+        self._queued += 1
+        HEAVY_QUEUED.labels(self.name).inc()
+
+    async def _run_limited(self, func, *args):
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._queued -= 1
+            HEAVY_QUEUED.labels(self.name).dec()
+
+        HEAVY_REQUESTS.labels(self.name, "run").inc()
+        HEAVY_RUNNING.labels(self.name).inc()
+        self._running += 1
+        try:
+            return await run_in_threadpool(func, *args)
+        finally:
+            self._running -= 1
+            HEAVY_RUNNING.labels(self.name).dec()
+            self._semaphore.release()
@@ -0,0 +1,141 @@
+import logging
+from collections import Counter
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from db_models import Book, Verse, BookStats, ProjectStats, BookVocabulary, ProjectVocabulary
+
+
+PUNCTUATION = "!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~“”‘’«»¡¿।॥"
+COUNT_COLUMNS = ("verse_count", "token_count", "char_count")
+# With the project id, serializes counting books that have no statistics row yet
+STATS_LOCK_ID = 7_120_444
+
+
+def vocabulary_tokens(text):
+    """ Lower-cased whitespace tokens with surrounding punctuation removed """
+    for token in text.split():
+        token = token.strip(PUNCTUATION).lower()
+        if token:
+            yield token
+
+
+class VerseSummary:
+    """ Verse, token and character counts plus token frequencies, accumulated one verse at a time """
+    def __init__(self, texts=()):
+        self.counts = dict.fromkeys(COUNT_COLUMNS, 0)
+        self.vocabulary = Counter()
+        for text in texts:
+            self.add(text)
+
+    def add(self, text):
+        self.counts["verse_count"] += 1
+        self.counts["token_count"] += len(text.split())
+        self.counts["char_count"] += len(text)
+        self.vocabulary.update(vocabulary_tokens(text))
+
+    def track(self, verse_rows):
+        """ Pass (chapter, verse, text) rows through while counting them, for streamed inserts """
+        for row in verse_rows:
+            self.add(row[2])
+            yield row
+
+
+def _add_counts(session, model, key_columns, keys, deltas):
+    """ Upsert a stats row, adding the deltas to the stored counts """
+    stmt = insert(model).values(**keys, **deltas, vocabulary_size=0)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={column: getattr(model, column) + stmt.excluded[column] for column in deltas},
+    )
+    session.execute(stmt)
+
+
+def _add_vocabulary(session, model, key_column, key, vocabulary_delta):
+    """ Add token count deltas to a vocabulary table and drop tokens whose count reaches zero """
+    if vocabulary_delta:
+        stmt = insert(model)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[key_column.name, "token"],
+            set_={"count": model.count + stmt.excluded.count},
+        )
+        session.execute(stmt, [{key_column.name: key, "token": token, "count": count} for token, count in vocabulary_delta.items()])
+        session.execute(delete(model).where(key_column == key, model.count <= 0))
+    return select(func.count()).select_from(model).where(key_column == key).scalar_subquery()
+
+
+def apply_verse_delta(session, book_id, project_id, removed_texts=(), added_texts=()):
+    """
+    Update book and project statistics for verses removed from and added to a book,
+    in the caller's transaction. Counts change by the difference only, so an update
+    that touches a few verses costs the same as those few verses.
+    """
+    apply_summary_delta(session, book_id, project_id, VerseSummary(removed_texts), VerseSummary(added_texts))
+
+
+def _lock_project_stats(session, project_id):
+    session.execute(text("SELECT pg_advisory_xact_lock(:lock_id, :project_id)"), {"lock_id": STATS_LOCK_ID, "project_id": project_id})
+
+
+def _has_book_stats(session, book_id):
+    return session.query(BookStats.book_id).filter(BookStats.book_id == book_id).first() is not None
+
+
+def _book_summary(session, book_id):
+    """ VerseSummary of every verse a book holds now """
+    return VerseSummary(text for (text,) in session.query(Verse.text).filter(Verse.book_id == book_id).yield_per(5000))
+
+
+def apply_summary_delta(session, book_id, project_id, removed, added):
+    """
+    apply_verse_delta for verses already summarized with VerseSummary. The verses must already
+    be written, since a book without a statistics row yet is counted from what it holds.
+    """
+    if not _has_book_stats(session, book_id):
+        _lock_project_stats(session, project_id)
+        if not _has_book_stats(session, book_id):
+            # A book stored before statistics were maintained never had its verses counted, so
+            # the delta is only complete if the added verses are all the book holds
+            stored = session.query(func.count(Verse.id)).filter(Verse.book_id == book_id).scalar()
+            removed = VerseSummary()
+            if stored != added.counts["verse_count"]:
+                logging.info(f"Counting statistics for Book ID {book_id} from its {stored} verses")
+                added = _book_summary(session, book_id)
+
+    deltas = {column: added.counts[column] - removed.counts[column] for column in COUNT_COLUMNS}
+    vocabulary_delta = Counter(added.vocabulary)
+    vocabulary_delta.subtract(removed.vocabulary)
+    vocabulary_delta = {token: count for token, count in vocabulary_delta.items() if count}
+
+    _add_counts(session, BookStats, ["book_id"], {"book_id": book_id, "project_id": project_id}, deltas)
+    _add_counts(session, ProjectStats, ["project_id"], {"project_id": project_id}, deltas)
+
+    book_vocabulary_size = _add_vocabulary(session, BookVocabulary, BookVocabulary.book_id, book_id, vocabulary_delta)
+    session.execute(update(BookStats).where(BookStats.book_id == book_id).values(vocabulary_size=book_vocabulary_size))
+    project_vocabulary_size = _add_vocabulary(session, ProjectVocabulary, ProjectVocabulary.project_id, project_id, vocabulary_delta)
+    session.execute(update(ProjectStats).where(ProjectStats.project_id == project_id).values(vocabulary_size=project_vocabulary_size))
+
+
+def _books_without_stats(session, project_id):
+    return (
+        session.query(Book.book_id)
+        .outerjoin(BookStats, BookStats.book_id == Book.book_id)
+        .filter(Book.project_id == project_id, BookStats.book_id.is_(None))
+        .all()
+    )
+
+
+def ensure_project_stats(session, project_id):
+    """ Compute statistics once for books that were stored before statistics were maintained """
+    if _books_without_stats(session, project_id):
+        # Concurrent callers would otherwise both add the same books; the second one finds them counted
+        _lock_project_stats(session, project_id)
+        for (book_id,) in _books_without_stats(session, project_id):
+            summary = _book_summary(session, book_id)
+            if summary.counts["verse_count"]:
+                logging.info(f"Backfilling statistics for Book ID {book_id}")
+                apply_summary_delta(session, book_id, project_id, VerseSummary(), summary)
+    session.commit()
+
+
+def stats_to_dict(row):
+    return {column: getattr(row, column) if row else 0 for column in COUNT_COLUMNS + ("vocabulary_size",)}
@@ -1,15 +1,24 @@
 import csv
-from http.client import HTTPException
+from fastapi import HTTPException
 import io
+import os
 import sys
-from usfm_grammar import USFMParser,Filter
-from db_models import Project, Book, Verse
+from usfm_grammar import Filter
+from usfm_grammar.filters import include_markers_in_usj
+from usfm_grammar.list_generator import ListGenerator
+from db_models import Project, Book, Verse, VerseSignature, VerseBand
+from metrics import stage
+import corpus_stats
+import read_model
+from sqlalchemy import delete, func, literal, literal_column, text, update
 import logging
 import hashlib
 import unicodedata
 from sacremoses import MosesPunctNormalizer
 import re
+import threading
 import typing as tp
+from collections import OrderedDict
 
 
  
@@ -42,25 +51,162 @@ def normalize_text(text: str) -> str:
     clean = unicodedata.normalize("NFKC", clean)  # Normalize Unicode characters
     return clean
 
-def parse_usfm_to_csv(book_name, usfm_content, project_id):
-    """ Convert USFM content to CSV format and return extracted data """
-    try:
-        my_parser = USFMParser(usfm_content)  # Initialize parser
-        output = my_parser.to_list(include_markers=Filter.BCV + Filter.TEXT)  # Extract BCV and Text      
-        processed_output = [
-            [re.sub(r"\s+", " ", value).strip() if isinstance(value, str) else value for value in row]
-            for row in output
-        ]            
-        if not processed_output:
-            logging.error(f"No data extracted for {book_name}!")
-        else:
-            logging.info(f"Extracted {len(processed_output)} verses for {book_name}")
-
-        return processed_output  #  Ensure we return the extracted verse data
-    except Exception as e:
-        logging.error(f"Error processing USFM content for {book_name}: {str(e)}")
-        return None
+def _line_chunks(text, size=64 * 1024):
+    """ Slices of about `size` characters that always end just after a line break """
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + size)
+        end = len(text) if end < 0 else end + 1
+        yield text[start:end]
+        start = end
 
+def normalize_book_text(text: str) -> str:
+    """
+    normalize_text for a whole USFM book, applied a line-aligned slice at a time so that no
+    step builds several whole-book temporaries. None of the punctuation substitutions match
+    across a line break, and mpn.normalize only strips the ends of the text, so the output is
+    identical to normalize_text(text).
+    """
+    substituted = []
+    for chunk in _line_chunks(text):
+        for regexp, substitution in mpn.substitutions:
+            chunk = regexp.sub(substitution, chunk)
+        substituted.append(chunk)
+    text = "".join(substituted).strip()
+    del substituted
+    return "".join(unicodedata.normalize("NFKC", replace_nonprint(chunk)) for chunk in _line_chunks(text))
+
+def normalize_text_node(text: str) -> str:
+    """
+    normalize_text for one text value of a parsed book. Surrounding whitespace is kept as a
+    single space, since mpn.normalize strips it and the text would run into its neighbours.
+    """
+    core = text.strip()
+    if not core:
+        return " " if text else text
+    leading = " " if text[0].isspace() else ""
+    trailing = " " if text[-1].isspace() else ""
+    return leading + normalize_text(core) + trailing
+
+def normalize_text_nodes(texts):
+    """
+    normalize_text_node for many values at once. The punctuation substitutions run once over the
+    values joined by line breaks, which none of them match or produce (see normalize_book_text),
+    instead of once per value. Values with a line break inside them are normalized one by one.
+    """
+    texts = list(texts)
+    cores = [text.strip() for text in texts]
+    batched = [i for i, core in enumerate(cores) if core and "\n" not in core]
+    results = [None if core and "\n" not in core else normalize_text_node(text) for text, core in zip(texts, cores)]
+    joined = "\n".join(cores[i] for i in batched)
+    for regexp, substitution in mpn.substitutions:
+        joined = regexp.sub(substitution, joined)
+    for i, piece in zip(batched, joined.split("\n") if batched else ()):
+        text = texts[i]
+        leading = " " if text[0].isspace() else ""
+        trailing = " " if text[-1].isspace() else ""
+        results[i] = leading + unicodedata.normalize("NFKC", replace_nonprint(piece.strip())) + trailing
+    return results
+
+class TextNormalizationCache:
+    """
+    LRU of normalized text values keyed by their content, shared by every project in the process:
+    headings, refrains and unchanged verses recur across books and revisions.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def normalize_all(self, texts):
+        """ {text: normalized text} for a set of values; the misses are normalized in one batch """
+        found = {}
+        with self._lock:
+            for text in texts:
+                value = self._entries.get(text)
+                if value is not None:
+                    self._entries.move_to_end(text)
+                    found[text] = value
+            self.hits += len(found)
+        missing = [text for text in texts if text not in found]
+        normalized = dict(zip(missing, normalize_text_nodes(missing)))
+        with self._lock:
+            self.misses += len(missing)
+            self._entries.update(normalized)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        found.update(normalized)
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+# Used in NORMALIZATION_MODE=text
+text_normalization_cache = TextNormalizationCache(int(os.environ.get("NORMALIZATION_CACHE_SIZE", "100000")))
+
+def normalize_usj_text(usj_data):
+    """ Normalize every text value of a USJ document in place; markers and attributes stay as parsed """
+    slots = []
+    stack = [usj_data]
+    while stack:
+        content = stack.pop().get("content")
+        if not content:
+            continue
+        for index, item in enumerate(content):
+            if isinstance(item, str):
+                slots.append((content, index))
+            else:
+                stack.append(item)
+    normalized = text_normalization_cache.normalize_all({content[index] for content, index in slots})
+    for content, index in slots:
+        content[index] = normalized[content[index]]
+
+VERSE_LIST_MARKERS = Filter.BCV + Filter.TEXT
+
+def extract_verse_rows(usj_data, book_name):
+    """
+    Yield whitespace-cleaned BCV and text rows from a book's USJ. This is what
+    USFMParser.to_list(include_markers=Filter.BCV + Filter.TEXT) does internally, without
+    walking the syntax tree a second time. Rows are popped off as they are consumed.
+    """
+    filtered = include_markers_in_usj(usj_data, VERSE_LIST_MARKERS + ["USJ"] + Filter.BCV + ["USJ"])
+    list_generator = ListGenerator()
+    list_generator.usj_to_list(filtered, None, VERSE_LIST_MARKERS)
+    del filtered
+    output = list_generator.list
+    output.reverse()
+    while output:
+        row = output.pop()
+        yield [re.sub(r"\s+", " ", value).strip() if isinstance(value, str) else value for value in row]
+
+def normalize_verse_rows(rows, batch_size=1000):
+    """
+    For NORMALIZATION_MODE=text: normalize the joined text of each verse row through the cache.
+    Text values are normalized one node at a time, so substitutions around a character marker
+    (\\nd, \\add, \\wj, ...) only apply once the verse is one string again.
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield from _normalize_row_texts(batch)
+            batch = []
+    yield from _normalize_row_texts(batch)
+
+def _normalize_row_texts(rows):
+    # Rows are [book, chapter, verse, text, type, marker]; only verse text rows have no type
+    texts = [row for row in rows if len(row) > 4 and not row[4] and row[3]]
+    normalized = text_normalization_cache.normalize_all({row[3] for row in texts})
+    for row in texts:
+        row[3] = normalized[row[3]]
+    yield from rows
 
 def extract_book_code(usfm_content):
     """ Extract the book code from the USFM content using \id marker """
@@ -74,59 +220,131 @@ def compute_sha256(content):
     return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
 
-def insert_verses_into_db(book_name,project_id, verse_data, session):
-    """ Insert verses into the `verses` table by finding the correct `book_id` first. """
-    if not verse_data:  #Ensure verse_data is valid before inserting
-        logging.error(f"No verse data found for {book_name}, skipping insertion.")
-        return
+def valid_verse_rows(book_name, verse_data):
+    """ Yield (chapter, verse, text) for the parsed rows that belong to the book and have a valid reference and text """
+    for row in verse_data:
+        if len(row) >= 4:  # Ensure row has enough data
+            csv_book, chapter, verse, text = row[0], row[1], row[2], row[3]
+
+            # Skip rows that do not match the correct book
+            if csv_book != book_name:
+                continue
+            # Ensure chapter is a number
+            if not str(chapter).isdigit():
+                logging.warning(f"Skipping invalid chapter: {chapter}")
+                continue
+            # Ensure verse is not empty
+            if not str(verse).strip():
+                logging.warning(f"Skipping invalid verse: {verse}")
+                continue
+            # Ensure text is not empty
+            if not text.strip():
+                logging.warning(f"Skipping empty text for chapter {chapter}, verse {verse}")
+                continue
+            yield int(chapter), str(verse), text.replace("\n", " ")  # Clean text
+
+
+def stream_verses_into_db(book_name, project_id, book_id, verse_data, session):
+    """
+    COPY verse rows of a book and add them to the statistics, in the caller's transaction.
+    Rows are validated and counted as COPY reads them. Returns the number of verses inserted.
+    """
+    inserted = corpus_stats.VerseSummary()
+    copy_verses(session, book_id, inserted.track(valid_verse_rows(book_name, verse_data)))
+    corpus_stats.apply_summary_delta(session, book_id, project_id, corpus_stats.VerseSummary(), inserted)
+    return inserted.counts["verse_count"]
+
+
+class _CsvRowStream:
+    """ Read-only file object that renders rows as CSV on demand, for COPY ... FROM STDIN """
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        if size < 0:
+            data, self._pending = self._pending, ""
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+def copy_verses(session, book_id, verse_rows):
+    """
+    Load (chapter, verse, text) rows for a book with COPY, in the session's transaction.
+    Rows are rendered as COPY reads them, so a generator is consumed without being materialized.
+    """
+    stream = _CsvRowStream([book_id, chapter, verse, text] for chapter, verse, text in verse_rows)
+    cursor = session.connection().connection.cursor()
     try:
-        # Find the correct book_id from books table
-        book = session.query(Book).filter(Book.book_name == book_name, Book.project_id == project_id).first()
-        if not book:
-            logging.error(f"No book found for {book_name} in database.")
-            return
-        book_id = book.book_id
-        logging.info(f"Inserting verses for {book_name} (Book ID: {book_id})...")
-        for row in verse_data:
-            if len(row) >= 4:  # Ensure row has enough data
-                csv_book, chapter, verse, text = row[0], row[1], row[2], row[3]
-
-                # Skip rows that do not match the correct book
-                if csv_book != book_name:
-                    continue
-                # Ensure chapter is a number
-                if not str(chapter).isdigit():
-                    logging.warning(f"Skipping invalid chapter: {chapter}")
-                    continue
-                # Ensure verse is not empty
-                if not str(verse).strip():
-                    logging.warning(f"Skipping invalid verse: {verse}")
-                    continue
-                # Ensure text is not empty
-                if not text.strip():
-                    logging.warning(f"Skipping empty text for chapter {chapter}, verse {verse}")
-                    continue
-                # Insert into database
-                new_verse = Verse(
-                    book_id=book_id,
-                    chapter=int(chapter),
-                    verse=str(verse),
-                    text=text.replace("\n", " ")  # Clean text
-                )
-                session.add(new_verse)
-        session.commit()
-        logging.info(f"Successfully inserted verses for {book_name} (Book ID: {book_id})")
-    except Exception as e:
-        logging.error(f"Error inserting verses for {book_name}: {str(e)}")
-        session.rollback() 
+        cursor.copy_expert("COPY verses (book_id, chapter, verse, text) FROM STDIN WITH (FORMAT csv)", stream)
+    finally:
+        cursor.close()
 
 
+def sync_verses(session, book_id, verse_rows, first_chapter=None, last_chapter=None):
+    """
+    Make the stored verses of a book, or of a chapter range, match (chapter, verse, text) rows,
+    in the caller's transaction. Only verses that differ are written, so unchanged verses keep
+    their revision and delta exports see just the real changes. Returns the removed and added
+    VerseSummary for the statistics delta.
+    """
+    scope = Verse.book_id == book_id
+    if first_chapter is not None:
+        scope &= Verse.chapter.between(first_chapter, last_chapter)
+    stored = {}
+    for verse_id, chapter, verse, text in session.query(Verse.id, Verse.chapter, Verse.verse, Verse.text).filter(scope).order_by(Verse.id):
+        stored.setdefault((chapter, verse), []).append((verse_id, text))
+
+    removed = corpus_stats.VerseSummary()
+    added = corpus_stats.VerseSummary()
+    changed = []
+    inserted = []
+    for chapter, verse, text in verse_rows:
+        matches = stored.get((chapter, verse))
+        if matches:
+            verse_id, stored_text = matches.pop(0)
+            if stored_text != text:
+                changed.append({"id": verse_id, "text": text})
+                removed.add(stored_text)
+                added.add(text)
+        else:
+            inserted.append((chapter, verse, text))
+            added.add(text)
+    deleted = []
+    for matches in stored.values():
+        for verse_id, stored_text in matches:
+            deleted.append(verse_id)
+            removed.add(stored_text)
+
+    if deleted:
+        session.execute(delete(Verse).where(Verse.id.in_(deleted)))
+    if changed:
+        session.execute(update(Verse), changed)
+        # Near-duplicate signatures are computed from the text, so changed verses get new ones on the next scan
+        changed_ids = [row["id"] for row in changed]
+        session.execute(delete(VerseBand).where(VerseBand.verse_id.in_(changed_ids)))
+        session.execute(delete(VerseSignature).where(VerseSignature.verse_id.in_(changed_ids)))
+    if inserted:
+        copy_verses(session, book_id, inserted)
+    logging.info(f"Synced verses for Book ID {book_id}: {len(changed)} changed, {len(inserted)} added, {len(deleted)} removed")
+    return removed, added
 
 
 def update_verses_in_db(book_name, project_id, book_id, verse_data, session):
     """ 
-    Update verses in the `verses` table by **deleting existing verses** for the book first 
-    and then inserting the new verse data.
+    Update verses in the `verses` table to match the new verse data, writing only the verses
+    that were added, changed or removed.
     """
     
     if not verse_data:
@@ -134,36 +352,8 @@ def update_verses_in_db(book_name, project_id, book_id, verse_data, session):
         return
 
     try:
-        # Step 1: Delete all existing verses for the book
-        session.query(Verse).filter(Verse.book_id == book_id).delete()
-        
-        logging.info(f"Deleted existing verses for {book_name} (Book ID: {book_id}, Project ID: {project_id})")
-
-        # Step 2: Insert new verses from the updated USFM
-        new_verses = []
-        for row in verse_data:
-            if len(row) >= 4:
-                csv_book, chapter, verse, text = row[0], row[1], row[2], row[3]
-
-                # Ensure valid chapter, verse, and text
-                if not str(chapter).isdigit() or not str(verse).strip() or not text.strip():
-                    logging.warning(f"Skipping invalid data: Chapter {chapter}, Verse {verse}")
-                    continue
-
-                new_verses.append(Verse(
-                    book_id=book_id,
-                    chapter=int(chapter),
-                    verse=str(verse),
-                    text=text.replace("\n", " ")  # Clean text by removing line breaks
-                ))
-
-        # Bulk insert new verses
-        if new_verses:
-            session.bulk_save_objects(new_verses)
-            logging.info(f"Inserted {len(new_verses)} new verses for {book_name} (Book ID: {book_id})")
-        else:
-            logging.warning(f"No valid verses extracted for {book_name}")
-
+        removed, added = sync_verses(session, book_id, valid_verse_rows(book_name, verse_data))
+        corpus_stats.apply_summary_delta(session, book_id, project_id, removed, added)
         session.commit()
         logging.info(f"Successfully updated verses for {book_name} (Book ID: {book_id}, Project ID: {project_id})")
 
@@ -173,12 +363,32 @@ def update_verses_in_db(book_name, project_id, book_id, verse_data, session):
 
 
 
+def replace_chapter_verses(book_name, project_id, book_id, first_chapter, last_chapter, verse_rows, session):
+    """
+    Replace the verses of a chapter range with (chapter, verse, text) rows and apply the
+    statistics delta, in the caller's transaction. Returns the number of verses added or changed.
+    """
+    removed, added = sync_verses(session, book_id, verse_rows, first_chapter, last_chapter)
+    logging.info(f"Replaced verses of chapters {first_chapter}-{last_chapter} for {book_name} (Book ID: {book_id})")
+    corpus_stats.apply_summary_delta(session, book_id, project_id, removed, added)
+    return added.counts["verse_count"]
+
+
 def parse_verse_number(verse):
     """Convert verse numbers into sortable format (handles single verses and ranges like '1-2')."""
     if '-' in verse:
         return int(verse.split('-')[0])  # Take the first number in range (e.g., '1-2' → 1)
     return int(verse)  # Convert single verse to int
 
+def verse_numbers(verse):
+    """ Verse numbers covered by a verse label, '3' or a merged '3-5' """
+    start, _, end = verse.partition("-")
+    return range(int(start), int(end or start) + 1)
+
+def is_skipped(skip_keys, book_name, chapter, verse):
+    """ Whether a verse label, merged or not, covers any (book, chapter, verse number) in skip_keys """
+    return any((book_name, chapter, number) in skip_keys for number in verse_numbers(verse))
+
 def verses_to_dict( verse, text):
     """Helper function to convert verses to a dictionary."""
     return {
@@ -194,14 +404,57 @@ def get_project_id(session,project_name):
 
 def get_book_id(session, project_name, book_name):
     project_id = get_project_id(session,project_name)
-    book = session.query(Book).filter(Book.project_id == project_id, Book.book_name == book_name).first()
+    # Only the id column, so the stored USFM/USJ is not loaded for a lookup
+    book = session.query(Book.book_id).filter(Book.project_id == project_id, Book.book_name == book_name).first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     book_id = book.book_id
     return book_id
+
+# Books stored before USJ was kept as an object hold it as a JSON string scalar,
+# and books that failed to parse hold a JSON null
+USJ_DOCUMENT_SQL = "CASE jsonb_typeof(usj) WHEN 'string' THEN (usj #>> '{}')::jsonb WHEN 'null' THEN NULL ELSE usj END"
+
+def get_book_usj_text(session, book_id):
+    """ A book's stored USJ serialized by Postgres, or None if the book has none """
+    return session.execute(
+        text(f"SELECT ({USJ_DOCUMENT_SQL})::text FROM books WHERE book_id = :book_id"),
+        {"book_id": book_id},
+    ).scalar()
+
+def get_chapter_usj_text(session, book_id, chapter):
+    """
+    The USJ of one chapter, extracted and serialized inside Postgres. Chapters are milestones in
+    the top-level content, so a chapter is its marker plus every node up to the next marker.
+    Returns None if the book has no USJ or no such chapter.
+    """
+    return session.execute(text(f"""
+        WITH doc AS (
+            SELECT {USJ_DOCUMENT_SQL} AS usj FROM books WHERE book_id = :book_id
+        ), nodes AS (
+            SELECT node, position,
+                   count(*) FILTER (WHERE node ->> 'type' = 'chapter') OVER (ORDER BY position) AS chapter_group
+            FROM doc, jsonb_path_query(doc.usj, '$.content[*]') WITH ORDINALITY AS content(node, position)
+        ), chapters AS (
+            SELECT node, position, chapter_group,
+                   first_value(node ->> 'number') OVER (PARTITION BY chapter_group ORDER BY position) AS chapter_number
+            FROM nodes
+        )
+        SELECT jsonb_build_object(
+                   'type', 'USJ',
+                   'version', (SELECT usj -> 'version' FROM doc),
+                   'content', jsonb_agg(node ORDER BY position)
+               )::text
+        FROM chapters
+        WHERE chapter_group > 0 AND chapter_number = :chapter
+        HAVING count(*) > 0
+    """), {"book_id": book_id, "chapter": str(chapter)}).scalar()
         
-def get_verses(session, book_id):
-    verses = session.query(Verse.chapter, Verse.verse, Verse.text).filter(Verse.book_id == book_id).all()
+def get_verses(session, book_id, chapters=None):
+    query = session.query(Verse.chapter, Verse.verse, Verse.text).filter(Verse.book_id == book_id)
+    if chapters is not None:
+        query = query.filter(Verse.chapter.in_(chapters))
+    verses = query.all()
     verses_dict = {}
     merged_verses = {}
     
@@ -217,6 +470,97 @@ def get_merged_verse(merged_verse, verses_dict,chapter):
     merged_verse_text = " ".join([verses_dict.get((chapter, v), "") for v in split_verses]).strip()
     return merged_verse_text if merged_verse_text else None
 
+def verse_sort_key(key):
+    chapter, verse = key
+    return (int(chapter), int(verse.split("-")[0]) if "-" in verse else int(verse))
+
+def align_verses(verses_1_dict, merged_verses_1, verses_2_dict, merged_verses_2):
+    """
+    Align the verses of one book from two projects and return sorted (chapter, verse, text_1, text_2) rows.
+    - Retains existing merged verses if both projects have them.
+    - Merges split verses only if the other project has them merged.
+    - Skips missing verses.
+    """
+    final_verses_1 = verses_1_dict.copy()
+    final_verses_2 = verses_2_dict.copy()
+
+    # Preserve existing merged verses if both projects have them
+    for (chapter, merged_verse), merged_text in merged_verses_1.items():
+        if (chapter, merged_verse) in merged_verses_2:
+            # Both projects have the same merged verse, retain them
+            final_verses_1[(chapter, merged_verse)] = merged_text
+            final_verses_2[(chapter, merged_verse)] = merged_verses_2[(chapter, merged_verse)]
+        else:
+            # Merge split verses from Project 2
+            merged_text_2 = get_merged_verse(merged_verse, verses_2_dict,chapter)
+            final_verses_1[(chapter, merged_verse)] = merged_text
+            final_verses_2[(chapter, merged_verse)] = merged_text_2 if merged_text_2 else None
+
+    for (chapter, merged_verse), merged_text in merged_verses_2.items():
+        if (chapter, merged_verse) in merged_verses_1:
+            continue  # Already handled
+        # Merge split verses from Project 1
+        merged_text_1 = get_merged_verse(merged_verse, verses_1_dict,chapter)
+        final_verses_2[(chapter, merged_verse)] = merged_text
+        final_verses_1[(chapter, merged_verse)] = merged_text_1 if merged_text_1 else None
+
+    # Get all unique chapter-verse pairs and sort them
+    all_keys = sorted(set(final_verses_1.keys()) | set(final_verses_2.keys()), key=verse_sort_key)
+
+    aligned = []
+    for chapter, verse in all_keys:
+        text_1 = final_verses_1.get((chapter, verse))
+        text_2 = final_verses_2.get((chapter, verse))
+
+        # Skip missing verses
+        if text_1 is None or text_2 is None:
+            continue
+        aligned.append((chapter, verse, text_1, text_2))
+    return aligned
+
+def build_parallel_corpora(session, project_id_1, project_id_2, pipeline, skip_keys_1=None, skip_keys_2=None):
+    """
+    Align every book the two projects have in common.
+    Returns (book_name, chapter, verse, text_1, text_2) rows; rows covering a (book, chapter,
+    verse number) in skip_keys_1/skip_keys_2 for the respective project are left out, so a
+    merged '2-3' is dropped when verse 2 or 3 is.
+    """
+    # Fetch books for both projects, without their stored USFM/USJ
+    books_1 = session.query(Book.book_id, Book.book_name).filter(Book.project_id == project_id_1).all()
+    books_2 = session.query(Book.book_id, Book.book_name).filter(Book.project_id == project_id_2).all()
+
+    books_2_dict = {book.book_name: book.book_id for book in books_2}
+    common_books = [book for book in books_1 if book.book_name in books_2_dict]
+
+    if not common_books:
+        raise HTTPException(status_code=404, detail="No common books found between the two projects")
+
+    skip_keys_1 = skip_keys_1 or set()
+    skip_keys_2 = skip_keys_2 or set()
+    parallel_corpora = []
+    for book in common_books:
+        book_name = book.book_name
+
+        # get verses for book
+        with stage(pipeline, "load_verses", book=book_name):
+            if read_model.READ_MODEL_ENABLED:
+                book_verses_1 = read_model.get_book_verses(session, book.book_id)
+                book_verses_2 = read_model.get_book_verses(session, books_2_dict[book_name])
+            else:
+                verses_1_dict,merged_verses_1 = get_verses(session, book.book_id)
+                verses_2_dict,merged_verses_2 = get_verses(session, books_2_dict[book_name])
+
+        with stage(pipeline, "align", book=book_name):
+            if read_model.READ_MODEL_ENABLED:
+                aligned = read_model.align_books(book_verses_1, book_verses_2)
+            else:
+                aligned = align_verses(verses_1_dict, merged_verses_1, verses_2_dict, merged_verses_2)
+            for chapter, verse, text_1, text_2 in aligned:
+                if is_skipped(skip_keys_1, book_name, chapter, verse) or is_skipped(skip_keys_2, book_name, chapter, verse):
+                    continue
+                parallel_corpora.append((book_name, chapter, verse, text_1, text_2))
+    return parallel_corpora
+
 def create_csv(project_name_1,project_name_2, parallel_corpora,bcv):
     # Create CSV in memory
     output = io.StringIO()
@@ -233,3 +577,55 @@ def create_csv(project_name_1,project_name_2, parallel_corpora,bcv):
 
     output.seek(0)
     return output
+
+
+def trigram_available(session):
+    return session.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+
+# Search counts stop here, so a common word does not make every page visit all of its matches
+SEARCH_COUNT_LIMIT = int(os.environ.get("SEARCH_COUNT_LIMIT", "10000"))
+
+
+def search_verses(session, query, mode, project_id=None, book_name=None, chapter=None, offset=0, limit=20):
+    """
+    Ranked verse search. 'fulltext' matches words through the to_tsvector('simple', text) index,
+    'fuzzy' matches similar words through the pg_trgm index.
+    Returns (total, rows); total is the number of matches up to SEARCH_COUNT_LIMIT, or None
+    when there are more.
+    """
+    if mode == "fuzzy":
+        match = literal(query).op("<%")(Verse.text)
+        rank = func.word_similarity(query, Verse.text)
+    else:
+        # Must match the index expression exactly for the GIN index to be used
+        tsv = func.to_tsvector(literal_column("'simple'"), Verse.text)
+        tsquery = func.websearch_to_tsquery(literal_column("'simple'"), query)
+        match = tsv.op("@@")(tsquery)
+        rank = func.ts_rank(tsv, tsquery)
+
+    results = (
+        session.query(
+            Project.project_name, Book.book_name, Verse.chapter, Verse.verse, Verse.text,
+            rank.label("rank")
+        )
+        .join(Book, Book.book_id == Verse.book_id)
+        .join(Project, Project.project_id == Book.project_id)
+        .filter(match)
+    )
+    if project_id is not None:
+        results = results.filter(Book.project_id == project_id)
+    if book_name:
+        results = results.filter(Book.book_name == book_name)
+    if chapter is not None:
+        results = results.filter(Verse.chapter == chapter)
+
+    rows = (
+        results.order_by(rank.desc(), Project.project_name, Book.book_name, Verse.chapter, Verse.id)
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
+    # Counted separately: a window count is missing past the last page and ranks every match
+    matches = results.with_entities(literal(1)).limit(SEARCH_COUNT_LIMIT + 1).subquery()
+    total = session.query(func.count()).select_from(matches).scalar()
+    return (total if total <= SEARCH_COUNT_LIMIT else None), rows
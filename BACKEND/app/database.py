@@ -2,9 +2,11 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import urllib
 import os
+import json
+import logging
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
-from db_models import Base
+from db_models import Base, CURRENT_REVISION
 
 
 
@@ -22,8 +24,90 @@ DATABASE_URL = (
     f"{postgres_host}:{postgres_port}/{postgres_database}"
 )
 
-engine = create_engine(DATABASE_URL, pool_size=10, max_overflow=20)
+# Connections the whole server may open, shared equally by its worker processes (WEB_CONCURRENCY,
+# set by gunicorn_conf.py); one process keeps the original pool of 10 plus 20 overflow
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", "30"))
+SERVER_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+WORKER_CONNECTIONS = max(3, DB_MAX_CONNECTIONS // SERVER_WORKERS)
+POOL_SIZE = max(1, WORKER_CONNECTIONS // 3)
+MAX_OVERFLOW = WORKER_CONNECTIONS - POOL_SIZE
+
+# ensure_ascii=False keeps non-Latin USJ text at its UTF-8 size instead of \uXXXX escapes
+engine = create_engine(
+    DATABASE_URL, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+    json_serializer=lambda value: json.dumps(value, ensure_ascii=False)
+)
 SessionLocal = sessionmaker(bind=engine)
 
+# Created with IF NOT EXISTS so databases that predate them pick them up on start-up
+VERSE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_verses_book_chapter ON verses (book_id, chapter)",
+    "CREATE INDEX IF NOT EXISTS ix_verses_text_tsv ON verses USING gin (to_tsvector('simple', text))",
+]
+TRIGRAM_INDEX = "CREATE INDEX IF NOT EXISTS ix_verses_text_trgm ON verses USING gin (text gin_trgm_ops)"
+
+
+# Change tracking for delta exports: revision columns for databases created before them, a new
+# revision on every update and a tombstone for every deleted verse, whichever code path writes
+REVISION_DDL = [
+    f"ALTER TABLE books ADD COLUMN IF NOT EXISTS revision bigint NOT NULL DEFAULT {CURRENT_REVISION}",
+    f"ALTER TABLE verses ADD COLUMN IF NOT EXISTS revision bigint NOT NULL DEFAULT {CURRENT_REVISION}",
+    "CREATE INDEX IF NOT EXISTS ix_verses_revision ON verses (revision)",
+    f"""
+    CREATE OR REPLACE FUNCTION track_revision() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO verse_tombstones (book_id, chapter, verse, revision)
+            VALUES (OLD.book_id, OLD.chapter, OLD.verse, {CURRENT_REVISION});
+            RETURN OLD;
+        END IF;
+        NEW.revision := {CURRENT_REVISION};
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "CREATE OR REPLACE TRIGGER books_revision BEFORE UPDATE ON books FOR EACH ROW EXECUTE FUNCTION track_revision()",
+    "CREATE OR REPLACE TRIGGER verses_revision BEFORE UPDATE ON verses FOR EACH ROW EXECUTE FUNCTION track_revision()",
+    "CREATE OR REPLACE TRIGGER verses_tombstone AFTER DELETE ON verses FOR EACH ROW EXECUTE FUNCTION track_revision()",
+    # A book's revision also moves when any of its verses is written (once per statement, not per
+    # row), so the read model checks one row to see whether its copy of the book is current
+    f"""
+    CREATE OR REPLACE FUNCTION touch_book_revision() RETURNS trigger AS $$
+    BEGIN
+        UPDATE books SET revision = {CURRENT_REVISION} WHERE book_id IN (SELECT DISTINCT book_id FROM changed);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    *(
+        f"CREATE OR REPLACE TRIGGER verses_touch_book_{op.lower()} AFTER {op} ON verses "
+        f"REFERENCING {table} TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION touch_book_revision()"
+        for op, table in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"))
+    ),
+]
+
+# Job leases, for databases whose ingest_jobs table predates them
+INGEST_JOB_DDL = [
+    "ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS worker_id varchar",
+    "ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS lease_expires_at timestamptz",
+]
+
+
+# Held for the schema set-up transaction, so processes starting together (server workers that
+# each import the app) run it one after another instead of deadlocking on the DDL
+INIT_LOCK_ID = 7_120_443
+
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"SELECT pg_advisory_xact_lock({INIT_LOCK_ID})")
+        Base.metadata.create_all(bind=conn)
+        for statement in VERSE_INDEXES + REVISION_DDL + INGEST_JOB_DDL:
+            conn.exec_driver_sql(statement)
+    try:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"SELECT pg_advisory_xact_lock({INIT_LOCK_ID})")
+            conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            conn.exec_driver_sql(TRIGRAM_INDEX)
+    except Exception as e:
+        logging.warning(f"pg_trgm is not available, fuzzy verse search is disabled: {str(e)}")
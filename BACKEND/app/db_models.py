@@ -1,10 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text
+from sqlalchemy import Column, Integer, SmallInteger, BigInteger, String, ForeignKey, Text, DateTime, LargeBinary, func, text
 from sqlalchemy.orm import  declarative_base
 from sqlalchemy.dialects.postgresql import JSONB
 
 
 Base = declarative_base()
 
+# Revision of a row: the id of the transaction that last wrote it, which only ever increases
+CURRENT_REVISION = "(pg_current_xact_id()::text::bigint)"
+REVISION_DEFAULT = text(CURRENT_REVISION)
+
 class Project(Base):
     __tablename__ = "projects"
     
@@ -23,6 +27,7 @@ class Book(Base):
     usj = Column(JSONB, nullable=True)   
     usfm_sha=Column(String, nullable=False)
     status = Column(String, nullable=False)
+    revision = Column(BigInteger, nullable=False, server_default=REVISION_DEFAULT)
 
 
 class Verse(Base):
@@ -33,3 +38,88 @@ class Verse(Base):
     chapter = Column(Integer, nullable=False)
     verse = Column(String, nullable=False)
     text = Column(Text, nullable=False)
+    revision = Column(BigInteger, nullable=False, server_default=REVISION_DEFAULT, index=True)
+
+
+class VerseTombstone(Base):
+    __tablename__ = "verse_tombstones"
+
+    # Written by a trigger when a verse is deleted, so delta exports can report removals
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    book_id = Column(Integer, nullable=False, index=True)
+    chapter = Column(Integer, nullable=False)
+    verse = Column(String, nullable=False)
+    revision = Column(BigInteger, nullable=False, index=True)
+
+
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+
+    job_id = Column(String, primary_key=True)
+    job_type = Column(String, nullable=False)  # "upload" or "update"
+    project_name = Column(String, nullable=False)
+    usfm_sha = Column(String, nullable=False)
+    usfm = Column(Text, nullable=True)  # decoded payload, cleared once the job finishes
+    status = Column(String, nullable=False, index=True)  # queued, running, succeeded, failed
+    stage = Column(String, nullable=True)
+    book_id = Column(Integer, nullable=True)
+    errors = Column(JSONB, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    # Lease of a running job: the worker holding it renews it while it works on the job
+    worker_id = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class VerseSignature(Base):
+    __tablename__ = "verse_signatures"
+
+    verse_id = Column(Integer, ForeignKey("verses.id", ondelete="CASCADE"), primary_key=True)
+    project_id = Column(Integer, nullable=False, index=True)
+    signature = Column(LargeBinary, nullable=False)  # MinHash values as little-endian uint32
+
+
+class VerseBand(Base):
+    __tablename__ = "verse_lsh_bands"
+
+    verse_id = Column(Integer, ForeignKey("verses.id", ondelete="CASCADE"), primary_key=True)
+    band = Column(SmallInteger, primary_key=True)
+    band_hash = Column(BigInteger, nullable=False, index=True)  # hash of (band, band values)
+    project_id = Column(Integer, nullable=False, index=True)
+
+
+class BookStats(Base):
+    __tablename__ = "book_stats"
+
+    book_id = Column(Integer, ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    project_id = Column(Integer, ForeignKey("projects.project_id"), nullable=False, index=True)
+    verse_count = Column(Integer, nullable=False, default=0)
+    token_count = Column(BigInteger, nullable=False, default=0)
+    char_count = Column(BigInteger, nullable=False, default=0)
+    vocabulary_size = Column(Integer, nullable=False, default=0)
+
+
+class ProjectStats(Base):
+    __tablename__ = "project_stats"
+
+    project_id = Column(Integer, ForeignKey("projects.project_id"), primary_key=True)
+    verse_count = Column(Integer, nullable=False, default=0)
+    token_count = Column(BigInteger, nullable=False, default=0)
+    char_count = Column(BigInteger, nullable=False, default=0)
+    vocabulary_size = Column(Integer, nullable=False, default=0)
+
+
+class BookVocabulary(Base):
+    __tablename__ = "book_vocabulary"
+
+    book_id = Column(Integer, ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    token = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class ProjectVocabulary(Base):
+    __tablename__ = "project_vocabulary"
+
+    project_id = Column(Integer, ForeignKey("projects.project_id"), primary_key=True)
+    token = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
@@ -0,0 +1,210 @@
+import re
+import zlib
+import hashlib
+import logging
+import numpy as np
+from sqlalchemy.dialects.postgresql import insert
+from db_models import Project, Book, Verse, VerseSignature, VerseBand
+import crud
+
+
+# 16 bands of 4 rows put the LSH candidate threshold at a Jaccard similarity of about (1/16)**(1/4) = 0.5,
+# candidates are then verified against DEFAULT_THRESHOLD using the full signature
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+DEFAULT_THRESHOLD = 0.8
+BATCH_SIZE = 5000
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# Fixed seed: signatures are stored, so every process must use the same permutations
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, _MERSENNE_PRIME, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, _MERSENNE_PRIME, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingle_hashes(text):
+    """ 32-bit hashes of the character shingles of a verse, script independent """
+    clean = re.sub(r"\s+", " ", text.lower()).strip()
+    if len(clean) <= SHINGLE_SIZE:
+        grams = {clean}
+    else:
+        grams = {clean[i:i + SHINGLE_SIZE] for i in range(len(clean) - SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash(text):
+    """ MinHash signature of a verse, computed for all permutations at once """
+    hashes = shingle_hashes(text)
+    permuted = ((hashes[:, None] * _PERM_A + _PERM_B) % _MERSENNE_PRIME) & _MAX_HASH
+    return permuted.min(axis=0).astype("<u4")
+
+
+def band_hashes(signature):
+    """ One LSH bucket key per band; the band number is hashed in so buckets never collide across bands """
+    keys = []
+    for band in range(BANDS):
+        chunk = signature[band * ROWS:(band + 1) * ROWS].tobytes()
+        digest = hashlib.blake2b(bytes([band]) + chunk, digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "little", signed=True))
+    return keys
+
+
+def similarity(signature_1, signature_2):
+    """ Estimated Jaccard similarity of two verses """
+    return float(np.mean(signature_1 == signature_2))
+
+
+def index_verses(session, project_id=None):
+    """
+    Compute and store signatures for verses that do not have one yet, for one project or all of them.
+    Only new or replaced verses are processed, so repeated calls are cheap. Concurrent calls may
+    compute the same verses; whichever stores a signature first wins and the other skips it.
+    """
+    pending = (
+        session.query(Verse.id, Verse.text, Book.project_id)
+        .join(Book, Book.book_id == Verse.book_id)
+        .outerjoin(VerseSignature, VerseSignature.verse_id == Verse.id)
+        .filter(VerseSignature.verse_id.is_(None))
+    )
+    if project_id is not None:
+        pending = pending.filter(Book.project_id == project_id)
+    pending = pending.all()
+
+    for start in range(0, len(pending), BATCH_SIZE):
+        signatures = []
+        bands = []
+        for verse_id, text, verse_project_id in pending[start:start + BATCH_SIZE]:
+            signature = minhash(text)
+            signatures.append({"verse_id": verse_id, "project_id": verse_project_id, "signature": signature.tobytes()})
+            bands.extend(
+                {"verse_id": verse_id, "band": band, "band_hash": band_hash, "project_id": verse_project_id}
+                for band, band_hash in enumerate(band_hashes(signature))
+            )
+        session.execute(insert(VerseSignature).on_conflict_do_nothing(), signatures)
+        session.execute(insert(VerseBand).on_conflict_do_nothing(), bands)
+    session.commit()
+    if pending:
+        logging.info(f"Computed MinHash signatures for {len(pending)} verses")
+    return len(pending)
+
+
+def _load_signatures(session, verse_ids):
+    signatures = {}
+    verse_ids = list(verse_ids)
+    for start in range(0, len(verse_ids), BATCH_SIZE):
+        rows = (
+            session.query(VerseSignature.verse_id, VerseSignature.signature)
+            .filter(VerseSignature.verse_id.in_(verse_ids[start:start + BATCH_SIZE]))
+            .all()
+        )
+        signatures.update((verse_id, np.frombuffer(signature, dtype="<u4")) for verse_id, signature in rows)
+    return signatures
+
+
+def _find(parents, verse_id):
+    while parents[verse_id] != verse_id:
+        parents[verse_id] = parents[parents[verse_id]]
+        verse_id = parents[verse_id]
+    return verse_id
+
+
+def find_duplicate_groups(session, project_id, across_projects=False, threshold=DEFAULT_THRESHOLD):
+    """
+    Group near-duplicate verses of a project (and, optionally, their near-duplicates in other projects).
+    Each LSH bucket is only checked against its first member, so the work stays linear in bucket sizes.
+    Returns lists of verse ids, each sorted, largest group first.
+    """
+    bands = session.query(VerseBand.band_hash, VerseBand.verse_id)
+    if across_projects:
+        own_hashes = session.query(VerseBand.band_hash).filter(VerseBand.project_id == project_id)
+        bands = bands.filter(VerseBand.band_hash.in_(own_hashes.scalar_subquery()))
+    else:
+        bands = bands.filter(VerseBand.project_id == project_id)
+    rows = bands.order_by(VerseBand.band_hash, VerseBand.verse_id).all()
+
+    buckets = {}
+    for band_hash, verse_id in rows:
+        buckets.setdefault(band_hash, []).append(verse_id)
+    buckets = [members for members in buckets.values() if len(members) > 1]
+    signatures = _load_signatures(session, {verse_id for members in buckets for verse_id in members})
+
+    parents = {verse_id: verse_id for verse_id in signatures}
+    for head, *rest in buckets:
+        for verse_id in rest:
+            if similarity(signatures[head], signatures[verse_id]) >= threshold:
+                parents[_find(parents, verse_id)] = _find(parents, head)
+
+    groups = {}
+    for verse_id in parents:
+        groups.setdefault(_find(parents, verse_id), []).append(verse_id)
+    groups = [sorted(members) for members in groups.values() if len(members) > 1]
+    return sorted(groups, key=lambda members: (-len(members), members[0]))
+
+
+def describe_verses(session, verse_ids):
+    """ Project, book and reference of the given verses, keyed by verse id """
+    verse_ids = list(verse_ids)
+    details = {}
+    for start in range(0, len(verse_ids), BATCH_SIZE):
+        rows = (
+            session.query(Verse.id, Project.project_id, Project.project_name, Book.book_name, Verse.chapter, Verse.verse, Verse.text)
+            .join(Book, Book.book_id == Verse.book_id)
+            .join(Project, Project.project_id == Book.project_id)
+            .filter(Verse.id.in_(verse_ids[start:start + BATCH_SIZE]))
+            .all()
+        )
+        details.update((row.id, row) for row in rows)
+    return details
+
+
+def find_clusters(session, project_id, across_projects=False, threshold=DEFAULT_THRESHOLD):
+    """ Near-duplicate clusters of a project with the reference and text of every member """
+    index_verses(session, None if across_projects else project_id)
+    groups = find_duplicate_groups(session, project_id, across_projects, threshold)
+    details = describe_verses(session, {verse_id for members in groups for verse_id in members})
+
+    clusters = []
+    for members in groups:
+        rows = [details[verse_id] for verse_id in members if verse_id in details]
+        if across_projects and not any(row.project_id == project_id for row in rows):
+            continue
+        clusters.append({
+            "size": len(rows),
+            "members": [
+                {
+                    "verse_id": row.id,
+                    "project_name": row.project_name,
+                    "book": row.book_name,
+                    "chapter": row.chapter,
+                    "verse": row.verse,
+                    "text": row.text,
+                }
+                for row in rows
+            ],
+        })
+    return clusters
+
+
+def duplicate_verse_keys(session, project_id, threshold=DEFAULT_THRESHOLD):
+    """
+    (book, chapter, verse number) keys of a project's near-duplicate verses, keeping the first
+    occurrence of every cluster, for leaving duplicates out of exports. A merged verse gives a
+    key for each number it covers, so it also matches rows aligned with single verses.
+    """
+    index_verses(session, project_id)
+    groups = find_duplicate_groups(session, project_id, False, threshold)
+    details = describe_verses(session, {verse_id for members in groups for verse_id in members})
+
+    keys = set()
+    kept_keys = set()
+    for first, *rest in groups:
+        kept = details[first]
+        kept_keys.update((kept.book_name, kept.chapter, number) for number in crud.verse_numbers(kept.verse))
+        for verse_id in rest:
+            row = details[verse_id]
+            keys.update((row.book_name, row.chapter, number) for number in crud.verse_numbers(row.verse))
+    # The kept occurrence stays, also where a merged duplicate overlaps it
+    return keys - kept_keys
@@ -0,0 +1,109 @@
+import io
+import csv
+from fastapi import HTTPException
+from sqlalchemy import text
+from db_models import Book, Verse, VerseTombstone
+from metrics import stage
+import crud
+
+
+def current_revision(session):
+    """
+    Revision to pass as `since` next time: every transaction below it has finished, so its
+    changes are visible now, and anything written later has a revision at or above it.
+    """
+    return session.execute(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")).scalar()
+
+
+def _changes(session, book_ids, since):
+    """ (book_id, chapter, verse) of every verse added, changed or removed at or after since """
+    changed = session.query(Verse.book_id, Verse.chapter, Verse.verse).filter(
+        Verse.book_id.in_(book_ids), Verse.revision >= since
+    )
+    removed = session.query(VerseTombstone.book_id, VerseTombstone.chapter, VerseTombstone.verse).filter(
+        VerseTombstone.book_id.in_(book_ids), VerseTombstone.revision >= since
+    )
+    return changed.union_all(removed).all()
+
+
+def build_parallel_delta(session, project_id_1, project_id_2, since, pipeline, skip_keys_1=None, skip_keys_2=None):
+    """
+    Changes to the aligned corpus of two projects since a revision, as (upserts, removed):
+    - upserts: (book_name, chapter, verse, text_1, text_2) of every current pair that covers a
+      verse added, changed or removed in either project, aligned like build_parallel_corpora;
+    - removed: (book_name, chapter, verse) of pairs around those verses that no longer exist.
+    Only chapters with changes are loaded and aligned.
+    """
+    books_1 = {book_name: book_id for book_id, book_name in session.query(Book.book_id, Book.book_name).filter(Book.project_id == project_id_1)}
+    books_2 = {book_name: book_id for book_id, book_name in session.query(Book.book_id, Book.book_name).filter(Book.project_id == project_id_2)}
+    common_books = [book_name for book_name in books_1 if book_name in books_2]
+    if not common_books:
+        raise HTTPException(status_code=404, detail="No common books found between the two projects")
+
+    book_names = {books_1[book_name]: book_name for book_name in common_books}
+    book_names.update({books_2[book_name]: book_name for book_name in common_books})
+
+    # Verse numbers touched per (book, chapter), and the labels of deleted verses, which may have been pairs
+    touched = {}
+    candidates = {}
+    with stage(pipeline, "find_changes", since=since):
+        for book_id, chapter, verse in _changes(session, list(book_names), since):
+            key = (book_names[book_id], chapter)
+            touched.setdefault(key, set()).update(crud.verse_numbers(verse))
+            candidates.setdefault(key, set()).add(verse)
+
+    skip_keys_1 = skip_keys_1 or set()
+    skip_keys_2 = skip_keys_2 or set()
+    upserts = []
+    removed = []
+    for book_name in common_books:
+        chapters = sorted(chapter for name, chapter in touched if name == book_name)
+        if not chapters:
+            continue
+
+        with stage(pipeline, "load_verses", book=book_name, chapters=len(chapters)):
+            verses_1_dict, merged_verses_1 = crud.get_verses(session, books_1[book_name], chapters)
+            verses_2_dict, merged_verses_2 = crud.get_verses(session, books_2[book_name], chapters)
+
+        with stage(pipeline, "align", book=book_name):
+            aligned = crud.align_verses(verses_1_dict, merged_verses_1, verses_2_dict, merged_verses_2)
+            current = set()
+            for chapter, verse, text_1, text_2 in aligned:
+                if touched[(book_name, chapter)].isdisjoint(crud.verse_numbers(verse)):
+                    continue
+                if crud.is_skipped(skip_keys_1, book_name, chapter, verse) or crud.is_skipped(skip_keys_2, book_name, chapter, verse):
+                    continue
+                current.add((chapter, verse))
+                upserts.append((book_name, chapter, verse, text_1, text_2))
+
+            # Any stored reference overlapping a change may have been a pair before it
+            for chapter, verse in list(verses_1_dict) + list(merged_verses_1) + list(verses_2_dict) + list(merged_verses_2):
+                if not touched[(book_name, chapter)].isdisjoint(crud.verse_numbers(verse)):
+                    candidates[(book_name, chapter)].add(verse)
+            gone = [
+                (chapter, verse)
+                for chapter in chapters
+                for verse in candidates[(book_name, chapter)]
+                if (chapter, verse) not in current
+            ]
+            removed.extend((book_name, chapter, verse) for chapter, verse in sorted(gone, key=crud.verse_sort_key))
+    return upserts, removed
+
+
+def drop_filtered(upserts, kept, removed):
+    """ Report upserts rejected by the quality filters as removed, since an earlier export may hold them """
+    kept_keys = {row[:3] for row in kept}
+    return removed + [row[:3] for row in upserts if row[:3] not in kept_keys]
+
+
+def create_delta_csv(project_name_1, project_name_2, upserts, removed):
+    """ CSV of a delta export: the changed pairs, then the removed references with empty texts """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["Book", "Chapter", "Verse", project_name_1, project_name_2, "Change"])
+    for book_name, chapter, verse, text_1, text_2 in upserts:
+        writer.writerow([book_name, chapter, verse, text_1, text_2, "upsert"])
+    for book_name, chapter, verse in removed:
+        writer.writerow([book_name, chapter, verse, "", "", "removed"])
+    output.seek(0)
+    return output
@@ -0,0 +1,108 @@
+import unicodedata
+from functools import lru_cache
+from typing import Optional
+import numpy as np
+from pydantic import BaseModel, Field
+
+
+BATCH_SIZE = 20000
+
+
+class QualityFilters(BaseModel):
+    """ Optional filters for parallel corpus exports; a filter is off when its value is not set """
+    min_tokens: Optional[int] = Field(None, ge=0, description="Drop pairs where either side has fewer whitespace tokens")
+    max_tokens: Optional[int] = Field(None, ge=1, description="Drop pairs where either side has more whitespace tokens")
+    max_length_ratio: Optional[float] = Field(None, ge=1, description="Drop pairs whose longer side has more than this many times the characters of the shorter side")
+    drop_identical: bool = Field(False, description="Drop pairs whose two texts are identical")
+    source_script: Optional[str] = Field(None, description="Expected script of the first project, e.g. 'Latin'")
+    target_script: Optional[str] = Field(None, description="Expected script of the second project, e.g. 'Devanagari'")
+    max_non_script_ratio: float = Field(0.1, ge=0, le=1, description="Largest share of letters outside the expected script")
+
+    def active(self):
+        return any([
+            self.min_tokens is not None, self.max_tokens is not None, self.max_length_ratio is not None,
+            self.drop_identical, self.source_script, self.target_script,
+        ])
+
+
+@lru_cache(maxsize=None)
+def _letter_script(code_point):
+    """ Script of a letter or combining mark (first word of its Unicode name), '' for anything else """
+    char = chr(code_point)
+    if unicodedata.category(char)[0] not in ("L", "M"):
+        return ""
+    return unicodedata.name(char, "").split(" ")[0]
+
+
+def _counts(texts):
+    """ Character and whitespace-token counts of a batch of texts as arrays """
+    chars = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    tokens = np.fromiter((len(text.split()) for text in texts), dtype=np.int64, count=len(texts))
+    return chars, tokens
+
+
+def non_script_ratio(texts, script):
+    """
+    Share of letters in each text that are not in the given script. The whole batch is decoded into one
+    code point array, classified once per distinct character and summed per text with reduceat.
+    """
+    script = script.strip().upper()
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    code_points = np.frombuffer("".join(texts).encode("utf-32-le"), dtype="<u4")
+    if not len(code_points):
+        return np.zeros(len(texts))
+
+    unique, inverse = np.unique(code_points, return_inverse=True)
+    scripts = [_letter_script(int(code_point)) for code_point in unique]
+    is_letter = np.array([bool(name) for name in scripts])[inverse]
+    is_foreign = np.array([bool(name) and name != script for name in scripts])[inverse]
+
+    # reduceat needs valid, increasing offsets, so sum over non-empty texts only
+    non_empty = lengths > 0
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))[non_empty]
+    letters = np.zeros(len(texts), dtype=np.int64)
+    foreign = np.zeros(len(texts), dtype=np.int64)
+    letters[non_empty] = np.add.reduceat(is_letter.astype(np.int64), offsets)
+    foreign[non_empty] = np.add.reduceat(is_foreign.astype(np.int64), offsets)
+    return np.divide(foreign, letters, out=np.zeros(len(texts)), where=letters > 0)
+
+
+def _batch_masks(texts_1, texts_2, quality):
+    """ One boolean 'drop' mask per active filter for a batch of pairs """
+    chars_1, tokens_1 = _counts(texts_1)
+    chars_2, tokens_2 = _counts(texts_2)
+    masks = {}
+    if quality.min_tokens is not None:
+        masks["min_tokens"] = np.minimum(tokens_1, tokens_2) < quality.min_tokens
+    if quality.max_tokens is not None:
+        masks["max_tokens"] = np.maximum(tokens_1, tokens_2) > quality.max_tokens
+    if quality.max_length_ratio is not None:
+        shorter = np.maximum(np.minimum(chars_1, chars_2), 1)
+        masks["length_ratio"] = np.maximum(chars_1, chars_2) / shorter > quality.max_length_ratio
+    if quality.drop_identical:
+        masks["identical"] = np.array([a.strip() == b.strip() for a, b in zip(texts_1, texts_2)], dtype=bool)
+    if quality.source_script:
+        masks["source_script"] = non_script_ratio(texts_1, quality.source_script) > quality.max_non_script_ratio
+    if quality.target_script:
+        masks["target_script"] = non_script_ratio(texts_2, quality.target_script) > quality.max_non_script_ratio
+    return masks
+
+
+def filter_pairs(rows, quality):
+    """
+    Apply the quality filters to (book, chapter, verse, text_1, text_2) rows in batches.
+    Returns the kept rows and statistics with the number of pairs each filter rejected.
+    """
+    stats = {"total": len(rows), "kept": 0, "dropped": 0, "dropped_by": {}}
+    kept = []
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = rows[start:start + BATCH_SIZE]
+        masks = _batch_masks([row[3] for row in batch], [row[4] for row in batch], quality)
+        drop = np.zeros(len(batch), dtype=bool)
+        for name, mask in masks.items():
+            stats["dropped_by"][name] = stats["dropped_by"].get(name, 0) + int(mask.sum())
+            drop |= mask
+        kept.extend(row for row, dropped in zip(batch, drop) if not dropped)
+    stats["kept"] = len(kept)
+    stats["dropped"] = stats["total"] - stats["kept"]
+    return kept, stats
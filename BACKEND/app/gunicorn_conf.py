@@ -0,0 +1,81 @@
+"""
+Production server: gunicorn with uvicorn workers and the app preloaded in the master.
+
+    gunicorn -c gunicorn_conf.py main:app
+
+The master imports main once (init_db, the normalizer tables, the Moses regexes, the
+versification), freezes those objects out of the garbage collector and then forks the
+workers, which share the pages copy-on-write. A restarted worker is forked from the
+same master, so it starts without repeating any of that work. /ready answers 200 once
+a worker has finished its own warm-up (see main.lifespan).
+
+Metrics use prometheus_client's multiprocess mode, so /metrics reports the sum over all
+workers whichever one answers the scrape.
+"""
+import gc
+import os
+import glob
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count(), 4))))
+# Read by database.py to give each worker its share of DB_MAX_CONNECTIONS; the config is loaded before the app
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn_worker.UvicornWorker"
+# Off only to compare memory (benchmarks/worker_memory.py); every worker then imports the app itself
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+# Recycle workers after this many requests (0 = never); cheap because workers fork from the preloaded master
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+accesslog = "-"
+
+# Must be set before the app (and with it prometheus_client) is imported, which happens after this file
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    # Files left by a previous run would be added to this one's counts
+    for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(path)
+    created_metrics_dir = None
+else:
+    created_metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+
+
+def when_ready(server):
+    """ Runs in the master after the app is preloaded and before the first fork """
+    from database import engine
+    from prometheus_client import multiprocess
+
+    # Connections opened by init_db must not be shared with the workers
+    engine.dispose()
+    # Move everything allocated so far out of the collector's reach; otherwise the first
+    # collection in each worker writes to the object headers and un-shares the pages
+    gc.collect()
+    gc.freeze()
+    # The master serves no requests; its pool gauges from start-up must not count towards the workers'
+    multiprocess.mark_process_dead(os.getpid())
+    logging.info(f"Preloaded app, {gc.get_freeze_count()} objects frozen, forking {workers} workers")
+
+
+def post_fork(server, worker):
+    from database import engine
+
+    # Drop any pooled connection inherited from the master without closing it for the master
+    engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    """ Drop the gauges of a worker that exited; its counters and histograms are kept """
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if created_metrics_dir:
+        shutil.rmtree(created_metrics_dir, ignore_errors=True)
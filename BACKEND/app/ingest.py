@@ -0,0 +1,372 @@
+import os
+import re
+import json
+import codecs
+import hashlib
+import logging
+import base64
+from fastapi import HTTPException
+from sqlalchemy import update
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.attributes import flag_modified
+from usfm_grammar import USFMParser
+from db_models import Book
+import crud
+import read_model
+from metrics import stage
+
+
+CHAPTER_MARKER = re.compile(r"\\c\s+(\d+)")
+
+MAX_USFM_UPLOAD_BYTES = int(os.environ.get("MAX_USFM_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# "usfm": normalize the whole raw book, markers included, before parsing (the stored USFM is normalized).
+# "text": parse the book as uploaded and normalize only the text values of its USJ, with a cache.
+NORMALIZATION_MODE = os.environ.get("NORMALIZATION_MODE", "usfm").lower()
+
+
+def _noop_progress(stage_name):
+    pass
+
+
+async def read_usfm_stream(chunks, max_bytes=MAX_USFM_UPLOAD_BYTES):
+    """
+    Consume raw USFM bytes chunk by chunk, feeding an incremental SHA-256 and UTF-8 decoder,
+    so the upload is never held as base64 or as a complete bytes object.
+    Returns the decoded text and its SHA-256.
+    """
+    sha = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parts = []
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"USFM content exceeds the {max_bytes} byte limit")
+            sha.update(chunk)
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b"", final=True))
+    except UnicodeDecodeError as e:
+        logging.error(f"Failed to decode USFM content: {str(e)}")
+        raise HTTPException(status_code=400, detail="USFM content is not valid UTF-8")
+    if not size:
+        raise HTTPException(status_code=400, detail="USFM content is empty")
+    return "".join(parts), sha.hexdigest()
+
+
+def decode_usfm(encoded_usfm, pipeline, project_id):
+    """ Decode base64 encoded USFM content into a string """
+    try:
+        with stage(pipeline, "decode", project_id=project_id):
+            usfm_bytes = base64.b64decode(encoded_usfm)
+            return usfm_bytes.decode("utf-8")  # Decode from bytes to string
+    except Exception as e:
+        logging.error(f"Failed to decode USFM content: {str(e)}")
+        raise HTTPException(status_code=400, detail="Invalid encoded USFM content")
+
+
+def normalize_usfm(usfm, pipeline, project_id):
+    if NORMALIZATION_MODE == "text":
+        # The book is parsed as uploaded and parse_usj normalizes its text values instead
+        return usfm
+    try:
+        with stage(pipeline, "normalize", project_id=project_id, size=len(usfm)):
+            return crud.normalize_book_text(usfm)
+    except Exception as e:
+        logging.error(f"Failed to normalize USFM content: {str(e)}")
+        raise HTTPException(status_code=400, detail="Invalid encoded USFM content")
+
+
+def parse_usj(usfm, pipeline, book_name):
+    """
+    Convert USFM to a USJ dict. The syntax tree is several times the size of the book
+    and is released here; verse rows are later derived from the USJ itself.
+    """
+    usj_data = None
+    parsing_errors = []
+    try:
+        with stage(pipeline, "parse_usj", book=book_name):
+            my_parser = USFMParser(usfm)
+            usj_data = my_parser.to_usj()
+            parsing_errors = my_parser.errors
+            del my_parser
+        if NORMALIZATION_MODE == "text" and not parsing_errors:
+            with stage(pipeline, "normalize_text", book=book_name):
+                crud.normalize_usj_text(usj_data)
+    except Exception as e:
+        logging.error(f"USFM Parsing Failed: {str(e)}")
+        parsing_errors.append(str(e))
+    return usj_data, parsing_errors
+
+
+def extract_verse_rows(usj_data, book_name):
+    """ Verse rows of a parsed book; in text mode each verse's text is normalized once more as a whole """
+    rows = crud.extract_verse_rows(usj_data, book_name)
+    if NORMALIZATION_MODE == "text":
+        rows = crud.normalize_verse_rows(rows)
+    return rows
+
+
+def extract_book_name(usfm):
+    book_name = crud.extract_book_code(usfm)
+    if not book_name:
+        logging.error(f"Failed to extract book name ")
+        raise HTTPException(status_code=400, detail="Failed to extract book name")
+    return book_name
+
+
+def store_usj(session, book_id, usj_data):
+    """ Write a book's USJ with a column UPDATE, so no ORM object holds on to it """
+    session.execute(update(Book).where(Book.book_id == book_id).values(usj=usj_data))
+
+
+def upload_book(session, project_id, usfm, usfm_sha, progress=_noop_progress):
+    """
+    Normalize and parse a new book, store it and insert its verses.
+    Raises HTTPException for client errors; the book row is kept even if parsing fails.
+    The USFM is parsed once and verses are derived from the USJ and streamed into COPY.
+    The USFM and the USJ are written by separate statements so their encoded query
+    parameters never coexist, and each is released once written.
+    """
+    progress("normalize")
+    usfm = normalize_usfm(usfm, "upload", project_id)
+
+    # Extract book name from USFM
+    book_name = extract_book_name(usfm)
+    logging.info(f"Processing USFM file for book: {book_name}")
+    existing_book = session.query(Book.book_id).filter_by(book_name=book_name, project_id=project_id).first()
+    if existing_book:
+        logging.error(f"Book '{book_name}' already exists for Project ID {project_id}")
+        raise HTTPException(status_code=400, detail=f"Book '{book_name}' already exists for this project")
+
+    progress("parse_usj")
+    usj_data, parsing_errors = parse_usj(usfm, "upload", book_name)
+    status ="success" if not parsing_errors else json.dumps(parsing_errors)
+
+    progress("store_book")
+    new_book = Book(
+        book_name=book_name,
+        project_id=project_id,
+        usfm=usfm,
+        usj=None,
+        usfm_sha=usfm_sha,
+        status=status
+    )
+    with stage("upload", "store_book", book=book_name):
+        session.add(new_book)
+        session.flush()
+    book_id = new_book.book_id
+    # Detach the row so the session does not keep the USFM alive
+    session.expunge(new_book)
+    del new_book, usfm
+
+    # Raise an error if parsing failed, but still store data
+    if parsing_errors:
+        session.commit()
+        raise HTTPException(status_code=400, detail={"message": "USFM parsing failed", "errors": parsing_errors})
+
+    # Stream verses from the parse tree into the verses table
+    progress("insert_verses")
+    logging.info(f"Inserting verses into database for book: {book_name}")
+    with stage("upload", "insert_verses", book=book_name):
+        inserted = crud.stream_verses_into_db(book_name, project_id, book_id, extract_verse_rows(usj_data, book_name), session)
+    if not inserted:
+        logging.warning(f"No verse data extracted for {book_name}")
+
+    progress("store_usj")
+    with stage("upload", "store_usj", book=book_name):
+        store_usj(session, book_id, usj_data)
+    del usj_data
+
+    session.commit()
+    logging.info(f"Processing completed for Project ID: {project_id}, Book: {book_name}")
+    return book_id
+
+
+def update_book(session, project_id, usfm, usfm_sha, progress=_noop_progress):
+    """
+    Normalize and re-parse an existing book, update its record and replace its verses.
+    Raises HTTPException for client errors; the book row is updated even if parsing fails.
+    """
+    progress("normalize")
+    usfm = normalize_usfm(usfm, "update", project_id)
+
+    book_name = extract_book_name(usfm)
+    logging.info(f"Updating USFM file for book: {book_name}")
+
+    progress("parse_usj")
+    usj_data, parsing_errors = parse_usj(usfm, "update", book_name)
+
+    # Check if book entry exists in DB for the given project, without loading the old USFM/USJ
+    existing_book = (
+        session.query(Book)
+        .options(load_only(Book.book_id, Book.book_name, Book.project_id))
+        .filter_by(book_name=book_name, project_id=project_id)
+        .first()
+    )
+    if not existing_book:
+        # If the book does not exist, raise an error instead of inserting
+        logging.warning(f"Book {book_name} does not exist in project {project_id}. Update failed.")
+        raise HTTPException(status_code=404, detail="Book not found for the given project ID")
+
+    # Extract verses from the USJ instead of parsing the USFM again
+    verse_data = []
+    if not parsing_errors:
+        progress("parse_verses")
+        with stage("update", "parse_verses", book=book_name):
+            verse_data = list(extract_verse_rows(usj_data, book_name))
+
+    progress("store_book")
+    existing_book.usfm = usfm
+    existing_book.usj = usj_data if not parsing_errors else None
+    existing_book.usfm_sha = usfm_sha
+    existing_book.status = "success" if not parsing_errors else json.dumps(parsing_errors)  # Store errors instead of "failed"
+    book_id = existing_book.book_id
+    logging.info(f"Updated existing book entry: {book_name} (Book ID: {book_id})")
+    with stage("update", "store_book", book=book_name):
+        session.commit()
+    session.expunge(existing_book)
+    del existing_book, usj_data, usfm
+
+    # If parsing failed, raise an error but keep the book entry updated
+    if parsing_errors:
+        raise HTTPException(status_code=400, detail={"message": "USFM parsing failed", "errors": parsing_errors})
+
+    if verse_data:
+        progress("replace_verses")
+        logging.info(f"Updating verses in database for book: {book_name}")
+        with stage("update", "replace_verses", book=book_name, rows=len(verse_data)):
+            crud.update_verses_in_db(book_name, project_id, book_id, verse_data, session)
+    else:
+        logging.warning(f"No verse data extracted for {book_name}")
+
+    session.commit()
+    read_model.invalidate(book_id)
+    logging.info(f"USFM update completed for Project ID: {project_id}, Book: {book_name}")
+    return book_id
+
+
+def fragment_chapters(fragment):
+    """
+    Chapter numbers of a normalized chapter fragment. It must start with a \\c marker,
+    must not carry an \\id line and must cover consecutive chapters.
+    """
+    if fragment.startswith("\\id"):
+        raise HTTPException(status_code=400, detail="Chapter USFM must not contain an \\id marker")
+    markers = list(CHAPTER_MARKER.finditer(fragment))
+    if not markers or markers[0].start() != 0:
+        raise HTTPException(status_code=400, detail="Chapter USFM must start with a \\c marker")
+    chapters = [int(marker.group(1)) for marker in markers]
+    if chapters != list(range(chapters[0], chapters[0] + len(chapters))):
+        raise HTTPException(status_code=400, detail="Chapter USFM must contain consecutive chapters")
+    return chapters[0], chapters[-1]
+
+
+def _usfm_chapter_span(usfm, first_chapter, last_chapter):
+    """ Character span of the stored USFM holding the chapter range, or the point where it would go """
+    start = end = None
+    for marker in CHAPTER_MARKER.finditer(usfm):
+        number = int(marker.group(1))
+        if start is None and number >= first_chapter:
+            start = marker.start()
+        if number > last_chapter:
+            end = marker.start()
+            break
+    end = len(usfm) if end is None else end
+    return (end if start is None else start), end
+
+
+def _usj_chapter_span(content, first_chapter, last_chapter):
+    """ Slice of the top-level USJ content holding the chapter range; chapters are milestones at this level """
+    start = end = None
+    for index, node in enumerate(content):
+        if isinstance(node, dict) and node.get("type") == "chapter":
+            number = int(node["number"])
+            if start is None and number >= first_chapter:
+                start = index
+            if number > last_chapter:
+                end = index
+                break
+    end = len(content) if end is None else end
+    return (end if start is None else start), end
+
+
+def _append_separator(node):
+    """ Add the trailing space a whole-book parse gives the last text before a following chapter """
+    while isinstance(node, dict) and node.get("content"):
+        if isinstance(node["content"][-1], str):
+            node["content"][-1] += " "
+            return
+        node = node["content"][-1]
+
+
+def update_chapters(session, project_id, book_name, usfm, progress=_noop_progress):
+    """
+    Replace one chapter or a range of consecutive chapters of a stored book. Only the fragment
+    is normalized and parsed; the matching slices of the stored USFM and USJ and the verses of
+    those chapters are replaced, and usfm_sha is recomputed, in one transaction.
+    Returns (book_id, first_chapter, last_chapter, usfm_sha).
+    """
+    progress("normalize")
+    fragment = normalize_usfm(usfm, "update_chapters", project_id)
+    del usfm
+    # Text mode leaves the fragment as uploaded, so a BOM or blank lines before the first \c go here
+    fragment = fragment.lstrip("\ufeff").lstrip()
+    first_chapter, last_chapter = fragment_chapters(fragment)
+
+    # Lock the book so concurrent chapter updates splice in turn
+    book = (
+        session.query(Book)
+        .filter_by(book_name=book_name, project_id=project_id)
+        .with_for_update()
+        .first()
+    )
+    if not book:
+        logging.warning(f"Book {book_name} does not exist in project {project_id}. Chapter update failed.")
+        raise HTTPException(status_code=404, detail="Book not found for the given project ID")
+    if book.status != "success" or book.usj is None:
+        raise HTTPException(status_code=409, detail="The stored book has parsing errors, update the whole book instead")
+
+    usfm_start, usfm_end = _usfm_chapter_span(book.usfm, first_chapter, last_chapter)
+    before, after = book.usfm[:usfm_start], book.usfm[usfm_end:]
+    # Keep the separators a whole-book parse would see around the replaced chapters
+    separated = bool(before) and not before[-1].isspace()
+    if separated:
+        before += " "
+    if after and not fragment[-1].isspace():
+        fragment += " "
+
+    progress("parse_usj")
+    usj_data, parsing_errors = parse_usj(f"\\id {book_name} {fragment}", "update_chapters", book_name)
+    if parsing_errors:
+        raise HTTPException(status_code=400, detail={"message": "USFM parsing failed", "errors": parsing_errors})
+
+    progress("store_book")
+    with stage("update_chapters", "store_book", book=book_name):
+        # Books stored before USJ was kept as an object hold it as a JSON string
+        stored_usj = json.loads(book.usj) if isinstance(book.usj, str) else book.usj
+        usj_start, usj_end = _usj_chapter_span(stored_usj["content"], first_chapter, last_chapter)
+        if separated and usj_start:
+            _append_separator(stored_usj["content"][usj_start - 1])
+        stored_usj["content"][usj_start:usj_end] = [node for node in usj_data["content"] if node.get("type") != "book"]
+        book.usfm = before + fragment + after
+        book.usfm_sha = crud.compute_sha256(book.usfm)
+        book.usj = stored_usj
+        # The USJ is edited in place, which the ORM cannot detect on its own
+        flag_modified(book, "usj")
+        book_id, usfm_sha = book.book_id, book.usfm_sha
+        session.flush()
+    session.expunge(book)
+    del book, stored_usj, before, after
+
+    progress("replace_verses")
+    with stage("update_chapters", "replace_verses", book=book_name, chapters=f"{first_chapter}-{last_chapter}"):
+        verse_rows = crud.valid_verse_rows(book_name, extract_verse_rows(usj_data, book_name))
+        written = crud.replace_chapter_verses(book_name, project_id, book_id, first_chapter, last_chapter, verse_rows, session)
+
+    session.commit()
+    read_model.invalidate(book_id)
+    logging.info(f"Replaced chapters {first_chapter}-{last_chapter} of {book_name}, {written} verses written (Book ID: {book_id})")
+    return book_id, first_chapter, last_chapter, usfm_sha
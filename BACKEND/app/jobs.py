@@ -0,0 +1,196 @@
+import os
+import uuid
+import socket
+import logging
+import threading
+from datetime import timedelta
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, func
+from database import SessionLocal
+from db_models import IngestJob
+import crud
+import ingest
+
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+INGEST_QUEUE_LIMIT = int(os.environ.get("INGEST_QUEUE_LIMIT", "50"))
+JOB_POLL_SECONDS = float(os.environ.get("INGEST_JOB_POLL_SECONDS", "2"))
+# A running job's lease lasts this long and is renewed every quarter of it while the job runs;
+# once it has expired, the worker is assumed dead and another one retries the job
+JOB_STALE_SECONDS = int(os.environ.get("INGEST_JOB_STALE_SECONDS", "120"))
+JOB_HEARTBEAT_SECONDS = JOB_STALE_SECONDS / 4
+
+_wakeup = threading.Event()
+_stop = threading.Event()
+_workers = []
+
+
+def submit_job(session, job_type, project_name, usfm_sha, usfm):
+    """ Queue an upload/update job, refusing new work once the shared queue is full """
+    pending = (
+        session.query(func.count(IngestJob.job_id))
+        .filter(IngestJob.status.in_(("queued", "running")))
+        .scalar()
+    )
+    if pending >= INGEST_QUEUE_LIMIT:
+        logging.warning(f"Ingest queue is full ({pending} pending jobs), rejecting {job_type} for {project_name}")
+        raise HTTPException(status_code=429, detail="Ingest queue is full, retry later", headers={"Retry-After": "30"})
+
+    job = IngestJob(
+        job_id=uuid.uuid4().hex,
+        job_type=job_type,
+        project_name=project_name,
+        usfm_sha=usfm_sha,
+        usfm=usfm,
+        status="queued",
+    )
+    session.add(job)
+    session.commit()
+    _wakeup.set()
+    logging.info(f"Queued {job_type} job {job.job_id} for project {project_name}")
+    return job.job_id
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job.job_id,
+        "job_type": job.job_type,
+        "project_name": job.project_name,
+        "status": job.status,
+        "stage": job.stage,
+        "book_id": job.book_id,
+        "errors": job.errors,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+
+def _lease():
+    return func.now() + timedelta(seconds=JOB_STALE_SECONDS)
+
+
+def _update_job(job_id, worker_id, **fields):
+    """
+    Write job fields in a short session of their own so progress is visible immediately.
+    Only the worker holding the job's lease may write; returns False if it no longer does.
+    """
+    session = SessionLocal()
+    try:
+        updated = session.query(IngestJob).filter(
+            IngestJob.job_id == job_id, IngestJob.worker_id == worker_id, IngestJob.status == "running"
+        ).update(dict(fields, updated_at=func.now()), synchronize_session=False)
+        session.commit()
+        if not updated:
+            logging.warning(f"Ingest job {job_id} is no longer held by worker {worker_id}")
+        return bool(updated)
+    except Exception as e:
+        logging.error(f"Error updating ingest job {job_id}: {str(e)}")
+        session.rollback()
+        return True
+    finally:
+        session.close()
+
+
+def _heartbeat(job_id, worker_id, done):
+    """ Renew the job's lease until the job is done, so long stages are not taken for a dead worker """
+    while not done.wait(JOB_HEARTBEAT_SECONDS):
+        if not _update_job(job_id, worker_id, lease_expires_at=_lease()):
+            return
+
+
+def _claim_next_job(session, worker_id):
+    """ Lock the oldest runnable job so that workers in other replicas skip it, and take its lease """
+    job = (
+        session.query(IngestJob)
+        .filter(or_(
+            IngestJob.status == "queued",
+            and_(
+                IngestJob.status == "running",
+                # Jobs claimed before leases existed fall back to their last update
+                func.coalesce(IngestJob.lease_expires_at, IngestJob.updated_at + timedelta(seconds=JOB_STALE_SECONDS)) < func.now(),
+            ),
+        ))
+        .order_by(IngestJob.created_at)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if not job:
+        session.commit()
+        return None
+    if job.status == "running":
+        logging.warning(f"Lease of ingest job {job.job_id} held by {job.worker_id} expired, retrying it")
+    job.status = "running"
+    job.stage = "started"
+    job.worker_id = worker_id
+    job.lease_expires_at = _lease()
+    job.updated_at = func.now()
+    session.commit()
+    return job.job_id
+
+
+def _run_job(job_id, worker_id):
+    session = SessionLocal()
+    done = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job_id, worker_id, done), name=f"ingest-heartbeat-{job_id}", daemon=True)
+    heartbeat.start()
+    try:
+        job = session.get(IngestJob, job_id)
+        job_type, project_name, usfm_sha, usfm = job.job_type, job.project_name, job.usfm_sha, job.usfm
+        session.commit()
+
+        project_id = crud.get_project_id(session, project_name)
+        handler = ingest.upload_book if job_type == "upload" else ingest.update_book
+        book_id = handler(session, project_id, usfm, usfm_sha, progress=lambda stage_name: _update_job(job_id, worker_id, stage=stage_name))
+        _update_job(job_id, worker_id, status="succeeded", stage="done", book_id=book_id, usfm=None, lease_expires_at=None)
+        logging.info(f"Ingest job {job_id} succeeded (Book ID: {book_id})")
+    except HTTPException as e:
+        session.rollback()
+        errors = e.detail if isinstance(e.detail, dict) else {"message": e.detail}
+        _update_job(job_id, worker_id, status="failed", errors=errors, usfm=None, lease_expires_at=None)
+        logging.warning(f"Ingest job {job_id} failed: {e.detail}")
+    except Exception as e:
+        session.rollback()
+        _update_job(job_id, worker_id, status="failed", errors={"message": str(e)}, usfm=None, lease_expires_at=None)
+        logging.error(f"Ingest job {job_id} failed: {str(e)}")
+    finally:
+        done.set()
+        heartbeat.join()
+        session.close()
+
+
+def _worker_loop():
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}:{uuid.uuid4().hex[:8]}"
+    while not _stop.is_set():
+        session = SessionLocal()
+        try:
+            job_id = _claim_next_job(session, worker_id)
+        except Exception as e:
+            logging.error(f"Error claiming ingest job: {str(e)}")
+            session.rollback()
+            job_id = None
+        finally:
+            session.close()
+
+        if job_id is None:
+            _wakeup.wait(JOB_POLL_SECONDS)
+            _wakeup.clear()
+            continue
+        _run_job(job_id, worker_id)
+
+
+def start_workers():
+    """ Start the bounded pool of ingest worker threads for this process """
+    _stop.clear()
+    for i in range(INGEST_WORKERS):
+        worker = threading.Thread(target=_worker_loop, name=f"ingest-worker-{i}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+    logging.info(f"Started {INGEST_WORKERS} ingest workers")
+
+
+def stop_workers():
+    _stop.set()
+    _wakeup.set()
+    for worker in _workers:
+        worker.join(timeout=5)
+    _workers.clear()
@@ -1,15 +1,48 @@
-from fastapi import FastAPI
-from database import init_db
+import os
+import time
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import text
+from database import init_db, engine
 from fastapi.middleware.cors import CORSMiddleware
 import router
+import metrics
+import jobs
 
 # # Initialize the database
 init_db()
 
 
 
+def warm_up():
+    """
+    Per-process warm-up, run after any fork by the server. Shared read-only state (schema,
+    normalizer tables, versification) is already built at import; this opens a connection
+    of this process's own pool.
+    """
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Ingest workers are started per process, after any fork by the server
+    app.state.ready = False
+    jobs.start_workers()
+    start = time.perf_counter()
+    await run_in_threadpool(warm_up)
+    app.state.ready = True
+    logging.info(f"Worker {os.getpid()} ready in {(time.perf_counter() - start) * 1000:.0f} ms")
+    yield
+    app.state.ready = False
+    jobs.stop_workers()
+
+
 # FastAPI app initialization
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,6 +55,35 @@ app.add_middleware(
 # Include the router
 app.include_router(router.router)
 
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """ Count requests and record latency per endpoint (route template, not raw URL) """
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        metrics.observe_request(request.method, endpoint, status, time.perf_counter() - start)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """ Expose request, stage timing and DB pool metrics in Prometheus format """
+    content, content_type = metrics.render_latest()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """ 200 once this worker has finished warming up, 503 before that and while shutting down """
+    if getattr(app.state, "ready", False):
+        return {"status": "ready"}
+    return JSONResponse(status_code=503, content={"status": "starting"})
+
 @app.get("/")
 async def root():
     return {"message": "Data Analysis app is running successfully 🚀"}
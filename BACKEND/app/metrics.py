@@ -0,0 +1,97 @@
+import os
+import logging
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from database import engine
+
+
+# Set by gunicorn_conf.py: every worker writes its metrics to files there and a scrape, whichever
+# worker serves it, adds them up. Gauges sum over the live workers.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+REQUEST_COUNT = Counter(
+    "http_requests_total",
+    "Total HTTP requests handled, by endpoint and status code",
+    ["method", "endpoint", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency in seconds, by endpoint",
+    ["method", "endpoint"],
+)
+STAGE_LATENCY = Histogram(
+    "pipeline_stage_duration_seconds",
+    "Time spent in each ingest/export stage in seconds",
+    ["pipeline", "stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+HEAVY_REQUESTS = Counter(
+    "heavy_requests_total",
+    "Requests to concurrency-limited endpoints, by outcome: run, coalesced (shared an identical request in flight) or rejected",
+    ["endpoint", "outcome"],
+)
+HEAVY_RUNNING = Gauge("heavy_requests_running", "Computations running on a concurrency-limited endpoint", ["endpoint"], multiprocess_mode="livesum")
+HEAVY_QUEUED = Gauge("heavy_requests_queued", "Requests waiting for a slot on a concurrency-limited endpoint", ["endpoint"], multiprocess_mode="livesum")
+DB_POOL_SIZE = Gauge("db_pool_size", "Configured size of the DB connection pool", multiprocess_mode="livesum")
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "DB connections currently checked out", multiprocess_mode="livesum")
+DB_POOL_CHECKED_IN = Gauge("db_pool_checked_in", "Idle DB connections held in the pool", multiprocess_mode="livesum")
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "DB connections opened beyond pool_size", multiprocess_mode="livesum")
+
+
+def _set_pool_gauges(pool, checked_out, checked_in, overflow):
+    DB_POOL_SIZE.set(pool.size())
+    DB_POOL_CHECKED_OUT.set(checked_out)
+    DB_POOL_CHECKED_IN.set(checked_in)
+    DB_POOL_OVERFLOW.set(max(overflow, 0))
+
+
+DB_POOL_SIZE.set(engine.pool.size())
+
+
+# Pool usage is recorded as it changes rather than read at scrape time, since a scrape only
+# reaches one worker. The pool is found through the engine on every event, as dispose() replaces it.
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool = engine.pool
+    _set_pool_gauges(pool, pool.checkedout(), pool.checkedin(), pool.overflow())
+
+
+@event.listens_for(engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    # Fired before the connection goes back: it is kept if the pool has room, else closed
+    pool = engine.pool
+    if pool.checkedin() < pool.size():
+        _set_pool_gauges(pool, pool.checkedout() - 1, pool.checkedin() + 1, pool.overflow())
+    else:
+        _set_pool_gauges(pool, pool.checkedout() - 1, pool.checkedin(), pool.overflow() - 1)
+
+
+@contextmanager
+def stage(pipeline, stage_name, **context):
+    """ Time a block as one stage of an ingest/export pipeline and log it as a structured span """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(pipeline, stage_name).observe(elapsed)
+        fields = " ".join(f"{key}={value}" for key, value in context.items())
+        logging.info(f"span pipeline={pipeline} stage={stage_name} duration_ms={elapsed * 1000:.1f} {fields}".rstrip())
+
+
+def observe_request(method, endpoint, status, elapsed):
+    REQUEST_COUNT.labels(method, endpoint, str(status)).inc()
+    REQUEST_LATENCY.labels(method, endpoint).observe(elapsed)
+
+
+def render_latest():
+    """ Return the current metrics in Prometheus text exposition format, across all workers in multiprocess mode """
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
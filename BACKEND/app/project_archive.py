@@ -0,0 +1,230 @@
+import io
+import os
+import json
+import hashlib
+import logging
+import tarfile
+import tempfile
+from fastapi import HTTPException
+from sqlalchemy import func, text
+from db_models import Project, Book, Verse
+from metrics import stage
+import corpus_stats
+
+
+# A dump is a .tar.gz of manifest.json plus the project's book and verse rows in PostgreSQL's
+# binary COPY format. Restoring COPYs the rows back, so the stored normalized USFM and USJ are
+# reused as they are and nothing is decoded, normalized or parsed again.
+ARCHIVE_FORMAT = 1
+MAX_ARCHIVE_BYTES = int(os.environ.get("MAX_PROJECT_ARCHIVE_BYTES", str(2 * 1024 * 1024 * 1024)))
+CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024
+
+BOOKS_MEMBER = "books.copy"
+VERSES_MEMBER = "verses.copy"
+
+DUMP_QUERIES = {
+    BOOKS_MEMBER: """
+        COPY (SELECT book_name, usfm, usj, usfm_sha, status FROM books WHERE project_id = {project_id} ORDER BY book_id)
+        TO STDOUT WITH (FORMAT binary)
+    """,
+    # Insertion order is kept, because a later row for the same reference wins in alignment
+    VERSES_MEMBER: """
+        COPY (
+            SELECT b.book_name, v.chapter, v.verse, v.text FROM verses v JOIN books b ON b.book_id = v.book_id
+            WHERE b.project_id = {project_id} ORDER BY v.id
+        ) TO STDOUT WITH (FORMAT binary)
+    """,
+}
+
+RESTORE_TABLES = [
+    "CREATE TEMP TABLE restore_books (book_name text, usfm text, usj jsonb, usfm_sha text, status text) ON COMMIT DROP",
+    "CREATE TEMP TABLE restore_verses (book_name text, chapter integer, verse text, text text, position bigserial) ON COMMIT DROP",
+]
+RESTORE_COPIES = {
+    BOOKS_MEMBER: "COPY restore_books FROM STDIN WITH (FORMAT binary)",
+    VERSES_MEMBER: "COPY restore_verses (book_name, chapter, verse, text) FROM STDIN WITH (FORMAT binary)",
+}
+
+
+def _file_sha256(f):
+    f.seek(0)
+    sha = hashlib.sha256()
+    while chunk := f.read(CHUNK_SIZE):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _add_member(tar, name, f, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    tar.addfile(info, f)
+
+
+def dump_project(session, project_id, project_name):
+    """
+    Write a project to a temporary .tar.gz file and return it, positioned at the start, with its manifest.
+    The rows are COPYed straight to disk, so memory use does not grow with the project.
+    The counts and both COPYs read one REPEATABLE READ, READ ONLY snapshot, so the manifest matches
+    the rows even while the project is being written to; the session's open transaction is ended first.
+    """
+    # The isolation level can only be chosen when a transaction begins
+    session.rollback()
+    session.connection(execution_options={"isolation_level": "REPEATABLE READ"}).exec_driver_sql("SET TRANSACTION READ ONLY")
+    verse_counts = dict(
+        session.query(Book.book_name, func.count(Verse.id))
+        .outerjoin(Verse, Verse.book_id == Book.book_id)
+        .filter(Book.project_id == project_id)
+        .group_by(Book.book_name)
+        .all()
+    )
+    books = session.query(Book.book_name, Book.usfm_sha, Book.status).filter(Book.project_id == project_id).order_by(Book.book_id).all()
+
+    members = {}
+    cursor = session.connection().connection.cursor()
+    try:
+        for name, query in DUMP_QUERIES.items():
+            with stage("dump", "copy_out", project_id=project_id, member=name):
+                data = tempfile.TemporaryFile()
+                cursor.copy_expert(query.format(project_id=int(project_id)), data)
+                members[name] = data
+    finally:
+        cursor.close()
+
+    manifest = {
+        "format": ARCHIVE_FORMAT,
+        "project_name": project_name,
+        "books": [
+            {"book_name": book.book_name, "usfm_sha": book.usfm_sha, "parsed": book.status == "success", "verse_count": verse_counts.get(book.book_name, 0)}
+            for book in books
+        ],
+        "verse_count": sum(verse_counts.values()),
+        "members": {name: {"size": data.tell(), "sha256": _file_sha256(data)} for name, data in members.items()},
+    }
+
+    archive = tempfile.TemporaryFile()
+    try:
+        with stage("dump", "compress", project_id=project_id), tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            body = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+            _add_member(tar, "manifest.json", io.BytesIO(body), len(body))
+            for name, data in members.items():
+                data.seek(0)
+                _add_member(tar, name, data, manifest["members"][name]["size"])
+    except Exception:
+        archive.close()
+        raise
+    finally:
+        for data in members.values():
+            data.close()
+    archive.seek(0)
+    logging.info(f"Dumped project {project_name} (Project ID: {project_id}): {len(books)} books, {manifest['verse_count']} verses")
+    return archive, manifest
+
+
+def iter_archive(archive):
+    """ Stream a dump file in chunks and close it when done """
+    try:
+        while chunk := archive.read(CHUNK_SIZE):
+            yield chunk
+    finally:
+        archive.close()
+
+
+async def receive_archive(chunks, max_bytes=MAX_ARCHIVE_BYTES):
+    """ Spool uploaded archive chunks to a temporary file, in memory up to SPOOL_SIZE """
+    archive = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"Archive exceeds the {max_bytes} byte limit")
+            archive.write(chunk)
+        if not size:
+            raise HTTPException(status_code=400, detail="Archive is empty")
+    except BaseException:
+        archive.close()
+        raise
+    archive.seek(0)
+    return archive
+
+
+def _read_manifest(tar):
+    try:
+        manifest = json.load(tar.extractfile("manifest.json"))
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Archive has no valid manifest.json")
+    if manifest.get("format") != ARCHIVE_FORMAT:
+        raise HTTPException(status_code=400, detail=f"Unsupported archive format: {manifest.get('format')}")
+    for name in RESTORE_COPIES:
+        if name not in manifest.get("members", {}):
+            raise HTTPException(status_code=400, detail=f"Archive manifest does not list {name}")
+    return manifest
+
+
+def _member(tar, manifest, name):
+    """ An archive member, checked against the size and SHA-256 in the manifest before it is loaded """
+    try:
+        f = tar.extractfile(name)
+    except KeyError:
+        f = None
+    if f is None:
+        raise HTTPException(status_code=400, detail=f"Archive is missing {name}")
+    expected = manifest["members"][name]
+    if _file_sha256(f) != expected["sha256"] or f.tell() != expected["size"]:
+        raise HTTPException(status_code=400, detail=f"Checksum mismatch for {name}")
+    f.seek(0)
+    return f
+
+
+def restore_project(session, archive, project_name=None):
+    """
+    Create a project from a dump, in one transaction, under its archived name or project_name.
+    Returns the new project ID and the manifest.
+    """
+    try:
+        tar = tarfile.open(fileobj=archive, mode="r:gz")
+    except (tarfile.TarError, OSError, EOFError):
+        raise HTTPException(status_code=400, detail="Archive is not a valid .tar.gz project dump")
+
+    with tar:
+        manifest = _read_manifest(tar)
+        project_name = project_name or manifest["project_name"]
+        if session.query(Project.project_id).filter(Project.project_name == project_name).first():
+            raise HTTPException(status_code=409, detail=f"Project '{project_name}' already exists")
+
+        project = Project(project_name=project_name)
+        session.add(project)
+        session.flush()
+        project_id = project.project_id
+
+        for statement in RESTORE_TABLES:
+            session.execute(text(statement))
+        cursor = session.connection().connection.cursor()
+        try:
+            for name, copy_sql in RESTORE_COPIES.items():
+                with stage("restore", "copy_in", project_id=project_id, member=name):
+                    cursor.copy_expert(copy_sql, _member(tar, manifest, name))
+        finally:
+            cursor.close()
+
+    with stage("restore", "insert", project_id=project_id):
+        session.execute(text("""
+            INSERT INTO books (project_id, book_name, usfm, usj, usfm_sha, status)
+            SELECT :project_id, book_name, usfm, usj, usfm_sha, status FROM restore_books
+        """), {"project_id": project_id})
+        inserted = session.execute(text("""
+            INSERT INTO verses (book_id, chapter, verse, text)
+            SELECT b.book_id, r.chapter, r.verse, r.text
+            FROM restore_verses r JOIN books b ON b.project_id = :project_id AND b.book_name = r.book_name
+            ORDER BY r.position
+        """), {"project_id": project_id}).rowcount
+    if inserted != manifest["verse_count"]:
+        raise HTTPException(status_code=400, detail=f"Archive holds {inserted} verses, manifest lists {manifest['verse_count']}")
+
+    # Statistics are computed here instead of being carried in the archive; this commits the restore
+    with stage("restore", "stats", project_id=project_id):
+        corpus_stats.ensure_project_stats(session, project_id)
+    logging.info(f"Restored project {project_name} (Project ID: {project_id}): {len(manifest['books'])} books, {inserted} verses")
+    return project_id, manifest
@@ -0,0 +1,167 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from db_models import Book, Verse
+
+
+# Optional in-process cache of verse data for alignment and coverage, off unless enabled
+READ_MODEL_ENABLED = os.environ.get("VERSE_READ_MODEL", "false").lower() in ("1", "true", "yes")
+READ_MODEL_MAX_BOOKS = int(os.environ.get("VERSE_READ_MODEL_MAX_BOOKS", "256"))
+
+# Verse numbers are packed into one int64 key per (chapter, start, end), which also sorts in that order
+_FIELD_BITS = 20
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class BookVerses:
+    """
+    The verses of one book as array columns: chapter, first and last verse number (equal for a
+    single verse) and the texts concatenated into one buffer, sliced by offsets. Rows are sorted
+    by (chapter, start, end) with one row per reference.
+    """
+    __slots__ = ("version", "chapters", "starts", "ends", "offsets", "buffer", "keys")
+
+    def __init__(self, version, rows):
+        self.version = version
+        # Rows come in id order; like the dicts they replace, a later row for a reference wins
+        latest = {}
+        for chapter, verse, text in rows:
+            start, _, end = verse.partition("-")
+            latest[(chapter, int(start), int(end or start))] = text
+        references = sorted(latest)
+
+        self.chapters = np.fromiter((ref[0] for ref in references), dtype=np.int32, count=len(references))
+        self.starts = np.fromiter((ref[1] for ref in references), dtype=np.int32, count=len(references))
+        self.ends = np.fromiter((ref[2] for ref in references), dtype=np.int32, count=len(references))
+        lengths = np.fromiter((len(latest[ref]) for ref in references), dtype=np.int64, count=len(references))
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self.buffer = "".join(latest[ref] for ref in references)
+        self.keys = reference_keys(self.chapters, self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def text(self, index):
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]]
+
+    def verse_label(self, index):
+        start, end = int(self.starts[index]), int(self.ends[index])
+        return str(start) if start == end else f"{start}-{end}"
+
+    def nbytes(self):
+        arrays = (self.chapters, self.starts, self.ends, self.offsets, self.keys)
+        return sum(array.nbytes for array in arrays) + len(self.buffer.encode("utf-8"))
+
+
+def reference_keys(chapters, starts, ends):
+    return (
+        (chapters.astype(np.int64) << (2 * _FIELD_BITS))
+        | (starts.astype(np.int64) << _FIELD_BITS)
+        | ends.astype(np.int64)
+    )
+
+
+def _book_version(session, book_id):
+    """
+    The book's revision, which every insert, update or delete of its verses moves (see
+    database.REVISION_DDL), including writes made by other processes. One row is read.
+    """
+    return session.query(Book.revision).filter(Book.book_id == book_id).scalar()
+
+
+def get_book_verses(session, book_id):
+    """ The cached array model of a book, loaded on first use and reloaded when its verses changed """
+    version = _book_version(session, book_id)
+    with _lock:
+        cached = _cache.get(book_id)
+        if cached is not None and cached.version == version:
+            _cache.move_to_end(book_id)
+            return cached
+
+    rows = (
+        session.query(Verse.chapter, Verse.verse, Verse.text)
+        .filter(Verse.book_id == book_id)
+        .order_by(Verse.id)
+        .yield_per(5000)
+    )
+    book_verses = BookVerses(version, rows)
+    logging.info(f"Loaded Book ID {book_id} into the verse read model ({len(book_verses)} verses, {book_verses.nbytes()} bytes)")
+    with _lock:
+        _cache[book_id] = book_verses
+        _cache.move_to_end(book_id)
+        while len(_cache) > READ_MODEL_MAX_BOOKS:
+            evicted, _ = _cache.popitem(last=False)
+            logging.info(f"Evicted Book ID {evicted} from the verse read model")
+    return book_verses
+
+
+def invalidate(book_id):
+    """ Drop a book after its verses changed; other processes notice through the version check """
+    with _lock:
+        _cache.pop(book_id, None)
+
+
+def _merged_text(singles, chapter, start, end):
+    """ Text of a verse range built from single verses, like crud.get_merged_verse """
+    wanted = reference_keys(
+        np.full(end - start + 1, chapter, dtype=np.int32),
+        np.arange(start, end + 1, dtype=np.int32),
+        np.arange(start, end + 1, dtype=np.int32),
+    )
+    positions = np.searchsorted(singles.keys, wanted)
+    parts = []
+    for key, position in zip(wanted, positions):
+        found = position < len(singles) and singles.keys[position] == key
+        parts.append(singles.text(position) if found else "")
+    merged = " ".join(parts).strip()
+    return merged if merged else None
+
+
+def align_books(verses_1, verses_2):
+    """
+    Array version of crud.align_verses with the same rules, returning sorted
+    (chapter, verse, text_1, text_2) rows:
+    - a reference both books have (single or merged) is paired directly;
+    - a merged verse only one book has is paired with the joined single verses of the other;
+    - anything else is skipped.
+    """
+    _, index_1, index_2 = np.intersect1d(verses_1.keys, verses_2.keys, assume_unique=True, return_indices=True)
+    pairs = [
+        (int(verses_1.keys[i]), verses_1.verse_label(i), verses_1.text(i), verses_2.text(j))
+        for i, j in zip(index_1, index_2)
+    ]
+
+    for own, other, own_first in ((verses_1, verses_2, True), (verses_2, verses_1, False)):
+        merged = np.flatnonzero((own.starts != own.ends) & ~np.isin(own.keys, other.keys))
+        for i in merged:
+            other_text = _merged_text(other, int(own.chapters[i]), int(own.starts[i]), int(own.ends[i]))
+            if other_text is None:
+                continue
+            texts = (own.text(i), other_text) if own_first else (other_text, own.text(i))
+            pairs.append((int(own.keys[i]), own.verse_label(i)) + texts)
+
+    pairs.sort(key=lambda pair: pair[0])
+    return [(key >> (2 * _FIELD_BITS), label, text_1, text_2) for key, label, text_1, text_2 in pairs]
+
+
+def missing_verses(book_verses, max_verses):
+    """
+    (chapter, verse) of every verse in the versification that is not present, in order.
+    Like find_missing_verses, a merged verse only covers its first and last number.
+    """
+    max_verses = np.array([int(count) for count in max_verses], dtype=np.int64)
+    expected_chapters = np.repeat(np.arange(1, len(max_verses) + 1, dtype=np.int64), max_verses)
+    chapter_starts = np.repeat(np.cumsum(max_verses) - max_verses, max_verses)
+    expected_verses = np.arange(len(expected_chapters), dtype=np.int64) - chapter_starts + 1
+
+    chapters = book_verses.chapters.astype(np.int64)
+    present = np.concatenate((
+        (chapters << _FIELD_BITS) | book_verses.starts,
+        (chapters << _FIELD_BITS) | book_verses.ends,
+    ))
+    missing = ~np.isin((expected_chapters << _FIELD_BITS) | expected_verses, present)
+    return list(zip(expected_chapters[missing].tolist(), expected_verses[missing].tolist()))
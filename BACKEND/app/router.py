@@ -1,19 +1,33 @@
 import itertools
-from fastapi import APIRouter, HTTPException,File,UploadFile,Query
+import os
+from fastapi import APIRouter, HTTPException,File,UploadFile,Query,Depends,Request
 from fastapi import Body
 from pydantic import BaseModel
 from database import SessionLocal
 import json
-from usfm_grammar import USFMParser,Filter
 from db_models import Project, Book, Verse
 import logging
 import csv
 import io
 import csv
 from fastapi.responses import StreamingResponse
+from starlette.datastructures import UploadFile as FormFile
+from starlette.formparsers import MultiPartParser, MultiPartException
 import crud
-from fastapi.responses import JSONResponse
-import base64
+import ingest
+import jobs
+import dedup
+import filters
+import corpus_stats
+import read_model
+import delta
+import concurrency
+import project_archive
+import training_export
+from starlette.concurrency import run_in_threadpool
+from db_models import IngestJob, BookStats, ProjectStats
+from fastapi.responses import JSONResponse, Response
+from metrics import stage
 
 
 
@@ -21,6 +35,16 @@ logging.basicConfig(level=logging.INFO)
 
 router = APIRouter()
 
+# Loaded once at import, so a preloaded server (gunicorn_conf.py) shares it with every worker
+VERSIFICATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "versification.json")
+try:
+    with open(VERSIFICATION_FILE, "r", encoding="utf-8") as f:
+        MAX_VERSES = json.load(f).get("maxVerses", {})
+    VERSIFICATION_ERROR = None
+except Exception as e:
+    MAX_VERSES, VERSIFICATION_ERROR = {}, str(e)
+    logging.error(f"Error loading versification.json: {VERSIFICATION_ERROR}")
+
 
  
 
@@ -34,6 +58,12 @@ class USFMUploadRequest(BaseModel):
     encoded_usfm: str
 
 
+class ChapterUpdateRequest(BaseModel):
+    project_name: str
+    book_name: str
+    encoded_usfm: str  # one or more consecutive chapters, starting with a \c marker
+
+
 @router.post("/add_project/")
 async def add_project(request: ProjectRequest):
     """ Add a new project and return the project ID """
@@ -107,76 +137,11 @@ async def upload_usfm(
     try:
         # Get project_id from project_name
         project_name = request.project_name
-        usfm_sha = request.usfm_sha
-        encoded_usfm = request.encoded_usfm
         project_id = crud.get_project_id(session,project_name)
         logging.info(f"Processing USFM file for project: {project_name} (Project ID: {project_id})")
 
-        try:
-            usfm_bytes = base64.b64decode(encoded_usfm)
-            usfm = usfm_bytes.decode("utf-8")  # Decode from bytes to string
-            usfm=crud.normalize_text(usfm)
-        except Exception as e:
-            logging.error(f"Failed to decode USFM content: {str(e)}")
-            raise HTTPException(status_code=400, detail="Invalid encoded USFM content")
-
-
-        # Extract book name from USFM
-        book_name = crud.extract_book_code(usfm)
-        if not book_name:
-            logging.error(f"Failed to extract book name ")
-            raise HTTPException(status_code=400, detail="Failed to extract book name")
-        
-        logging.info(f"Processing USFM file for book: {book_name}")
-        existing_book = session.query(Book).filter_by(book_name=book_name, project_id=project_id).first()
-        if existing_book:
-            logging.error(f"Book '{book_name}' already exists for Project ID {project_id}")
-            raise HTTPException(status_code=400, detail=f"Book '{book_name}' already exists for this project")
-
-        usj_text = None
-        parsing_errors = []
-        # Convert USFM to USJ
-        try:
-            my_parser = USFMParser(usfm)
-            usj_data = my_parser.to_usj()
-            usj_text = json.dumps(usj_data, ensure_ascii=False)
-            parsing_errors = my_parser.errors
-        except Exception as e:
-            logging.error(f"USFM Parsing Failed: {str(e)}")
-            parsing_errors.append(str(e))
-
-        status ="success" if not parsing_errors else json.dumps(parsing_errors)
-
-        new_book = Book(
-            book_name=book_name,
-            project_id=project_id,
-            usfm=usfm,
-            usj=usj_text if not parsing_errors else None,
-            usfm_sha=usfm_sha,
-            # error_message=json.dumps(parsing_errors) if parsing_errors else None
-            status=status
-        )
-        session.add(new_book)
-        session.commit()
-        session.refresh(new_book)
-        book_id = new_book.book_id
-
-        # Raise an error if parsing failed, but still store data
-        if parsing_errors:
-            raise HTTPException(status_code=400, detail={"message": "USFM parsing failed", "errors": parsing_errors})
-
-        # Convert USFM to CSV and insert verses
-        logging.info(f"Parsing USFM to CSV for book: {book_name}")
-        verse_data = crud.parse_usfm_to_csv(book_name, usfm, project_id)
-
-        if verse_data:
-            logging.info(f"Inserting verses into database for book: {book_name}")
-            crud.insert_verses_into_db(book_name,project_id, verse_data, session)
-        else:
-            logging.warning(f"No verse data extracted for {book_name}")
-
-        session.commit()
-        logging.info(f"Processing completed for Project ID: {project_id}, Book: {book_name}")
+        # Decoded inline so that no local keeps the raw text alive during processing
+        book_id = ingest.upload_book(session, project_id, ingest.decode_usfm(request.encoded_usfm, "upload", project_id), request.usfm_sha)
 
         return JSONResponse(
             content={"message": "USFM file processed successfully", "project_id": project_id, "book_id": book_id},
@@ -209,69 +174,10 @@ async def update_usfm(
     try:
         # Extract values from request body
         project_name = request.project_name
-        usfm_sha = request.usfm_sha
-        encoded_usfm = request.encoded_usfm
-        # Extract book name from USFM
         project_id = crud.get_project_id(session,project_name)
 
         logging.info(f"Updating USFM file for project: {project_name} (Project ID: {project_id})")
-        try:
-            usfm_bytes = base64.b64decode(encoded_usfm)
-            usfm = usfm_bytes.decode("utf-8")  # Convert bytes to string
-            usfm=crud.normalize_text(usfm)
-        except Exception as e:
-            logging.error(f"Failed to decode USFM content: {str(e)}")
-            raise HTTPException(status_code=400, detail="Invalid encoded USFM content")
-
-        book_name = crud.extract_book_code(usfm)
-        if not book_name:
-            logging.error(f"Failed to extract book name ")
-            raise HTTPException(status_code=400, detail="Failed to extract book name")
-        logging.info(f"Updating USFM file for book: {book_name}")
-        usj_text = None
-        parsing_errors = []
-        # Convert USFM to USJ
-        try:
-            my_parser = USFMParser(usfm)
-            usj_data = my_parser.to_usj()
-            usj_text = json.dumps(usj_data, ensure_ascii=False)
-            parsing_errors = my_parser.errors
-        except Exception as e:
-            logging.error(f"USFM Parsing Failed: {str(e)}")
-            parsing_errors.append(str(e))
-
-        # Check if book entry exists in DB for the given project
-        existing_book = session.query(Book).filter_by(book_name=book_name, project_id=project_id).first()
-        if existing_book:
-            #  Update the existing book record
-            existing_book.usfm = usfm
-            existing_book.usj = usj_text if not parsing_errors else None
-            existing_book.usfm_sha = usfm_sha
-            existing_book.status = "success" if not parsing_errors else json.dumps(parsing_errors)  # ✅ Store errors instead of "failed"
-            book_id = existing_book.book_id
-            logging.info(f"Updated existing book entry: {book_name} (Book ID: {book_id})")
-        else:
-            # If the book does not exist, raise an error instead of inserting
-            logging.warning(f"Book {book_name} does not exist in project {project_id}. Update failed.")
-            raise HTTPException(status_code=404, detail="Book not found for the given project ID")
-        session.commit()
-
-        # If parsing failed, raise an error but keep the book entry updated
-        if parsing_errors:
-            raise HTTPException(status_code=400, detail={"message": "USFM parsing failed", "errors": parsing_errors})
-
-        #  Convert USFM to CSV and update verses
-        logging.info(f"Re-parsing USFM to CSV for book: {book_name}")
-        verse_data = crud.parse_usfm_to_csv(book_name, usfm, project_id)
-
-        if verse_data:
-            logging.info(f"Updating verses in database for book: {book_name}")
-            crud.update_verses_in_db(book_name, project_id, book_id, verse_data, session)
-        else:
-            logging.warning(f"No verse data extracted for {book_name}")
-
-        session.commit()
-        logging.info(f"USFM update completed for Project ID: {project_id}, Book: {book_name}")
+        book_id = ingest.update_book(session, project_id, ingest.decode_usfm(request.encoded_usfm, "update", project_id), request.usfm_sha)
 
         return JSONResponse(
             content={"message": "USFM file updated successfully", "project_id": project_id, "book_id": book_id},
@@ -288,6 +194,250 @@ async def update_usfm(
         session.close()
 
 
+@router.put("/update_usfm/chapters/")
+async def update_usfm_chapters(
+    request: ChapterUpdateRequest
+):
+    """
+    Replace one chapter, or a range of consecutive chapters, of an existing book.
+    Only the given chapters are parsed; the rest of the book is left untouched.
+    """
+    session = SessionLocal()
+
+    try:
+        project_name = request.project_name
+        project_id = crud.get_project_id(session,project_name)
+
+        logging.info(f"Updating chapters of {request.book_name} for project: {project_name} (Project ID: {project_id})")
+        book_id, first_chapter, last_chapter, usfm_sha = ingest.update_chapters(
+            session, project_id, request.book_name, ingest.decode_usfm(request.encoded_usfm, "update_chapters", project_id)
+        )
+
+        return JSONResponse(
+            content={
+                "message": "Chapters updated successfully",
+                "project_id": project_id,
+                "book_id": book_id,
+                "chapters": list(range(first_chapter, last_chapter + 1)),
+                "usfm_sha": usfm_sha,
+            },
+            status_code=200
+        )
+    except HTTPException as e:
+        session.rollback()
+        raise e
+    except Exception as e:
+        logging.error(f"Error updating chapters: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+# Room for boundaries and part headers around the file in a multipart body
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+async def _limited_stream(request, max_bytes, kind, overhead=0):
+    """ The request body, failing with 413 as soon as more than max_bytes (plus overhead) have arrived """
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes + overhead:
+            raise HTTPException(status_code=413, detail=f"{kind} content exceeds the {max_bytes} byte limit")
+        yield chunk
+
+
+async def _raw_upload_chunks(request: Request, max_bytes=ingest.MAX_USFM_UPLOAD_BYTES, kind="USFM"):
+    """ Body chunks of an octet-stream upload, or of the first file in a multipart upload """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"{kind} content exceeds the {max_bytes} byte limit")
+
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        # Parsed from a capped stream rather than request.form(), which would spool a file of any size
+        parser = MultiPartParser(request.headers, _limited_stream(request, max_bytes, kind, MULTIPART_OVERHEAD_BYTES), max_files=1)
+        try:
+            form = await parser.parse()
+        except MultiPartException as e:
+            raise HTTPException(status_code=400, detail=f"Invalid multipart body: {e.message}")
+        upload = next((value for value in form.values() if isinstance(value, FormFile)), None)
+        if upload is None:
+            await form.close()
+            raise HTTPException(status_code=400, detail=f"No {kind} file found in the multipart body")
+
+        async def file_chunks():
+            try:
+                while chunk := await upload.read(ingest.STREAM_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                await form.close()
+        return file_chunks()
+    return _limited_stream(request, max_bytes, kind)
+
+
+async def _process_raw_usfm(request, project_name, usfm_sha, pipeline):
+    session = SessionLocal()
+    try:
+        project_id = crud.get_project_id(session, project_name)
+        logging.info(f"Processing raw USFM {pipeline} for project: {project_name} (Project ID: {project_id})")
+        with stage(pipeline, "receive", project_id=project_id):
+            received = list(await ingest.read_usfm_stream(await _raw_upload_chunks(request)))
+        computed_sha = received[1]
+        if usfm_sha and usfm_sha != computed_sha:
+            raise HTTPException(status_code=400, detail="usfm_sha does not match the SHA-256 of the uploaded content")
+
+        # Hand the text over without keeping a reference here, so ingest can release it
+        handler = ingest.upload_book if pipeline == "upload" else ingest.update_book
+        book_id = handler(session, project_id, received.pop(0), computed_sha)
+        message = "USFM file processed successfully" if pipeline == "upload" else "USFM file updated successfully"
+        return JSONResponse(
+            content={"message": message, "project_id": project_id, "book_id": book_id, "usfm_sha": computed_sha},
+            status_code=200
+        )
+    except HTTPException as e:
+        session.rollback()
+        raise e
+    except Exception as e:
+        logging.error(f"Error processing raw USFM {pipeline}: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+@router.post("/upload_usfm/raw/")
+async def upload_usfm_raw(request: Request, project_name: str, usfm_sha: str = Query(None)):
+    """
+    Upload a book as the raw USFM body (application/octet-stream or a multipart file) instead of base64 in JSON.
+    The body is hashed and decoded as it streams in; usfm_sha, if given, must be its SHA-256.
+    """
+    return await _process_raw_usfm(request, project_name, usfm_sha, "upload")
+
+
+@router.put("/update_usfm/raw/")
+async def update_usfm_raw(request: Request, project_name: str, usfm_sha: str = Query(None)):
+    """ Update a book from the raw USFM body, like /upload_usfm/raw/ """
+    return await _process_raw_usfm(request, project_name, usfm_sha, "update")
+
+
+@router.get("/project/dump/")
+async def dump_project(project_name: str):
+    """
+    Download a whole project as one .tar.gz archive: the stored (already normalized) USFM, the USJ
+    and the verse rows, for /project/restore/ in this or another environment.
+    """
+    session = SessionLocal()
+    try:
+        project_id = crud.get_project_id(session, project_name)
+        archive, _ = await run_in_threadpool(project_archive.dump_project, session, project_id, project_name)
+        return StreamingResponse(
+            project_archive.iter_archive(archive),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{project_name}.tar.gz"'},
+        )
+    except HTTPException as e:
+        session.rollback()
+        raise e
+    except Exception as e:
+        logging.error(f"Error dumping project {project_name}: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+@router.post("/project/restore/")
+async def restore_project(request: Request, project_name: str = Query(None, description="Restore under this name instead of the one in the archive")):
+    """
+    Create a project from a /project/dump/ archive sent as the raw body (application/gzip or
+    octet-stream) or as a multipart file. The rows are loaded with COPY without parsing any USFM.
+    Fails with 409 if the project already exists.
+    """
+    session = SessionLocal()
+    archive = None
+    try:
+        with stage("restore", "receive"):
+            archive = await project_archive.receive_archive(
+                await _raw_upload_chunks(request, project_archive.MAX_ARCHIVE_BYTES, "Archive")
+            )
+        project_id, manifest = await run_in_threadpool(project_archive.restore_project, session, archive, project_name)
+        return JSONResponse(
+            content={
+                "message": "Project restored successfully",
+                "project_id": project_id,
+                "project_name": project_name or manifest["project_name"],
+                "books": len(manifest["books"]),
+                "verses": manifest["verse_count"],
+            },
+            status_code=200
+        )
+    except HTTPException as e:
+        session.rollback()
+        raise e
+    except Exception as e:
+        logging.error(f"Error restoring project: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        if archive is not None:
+            archive.close()
+        session.close()
+
+
+def _submit_ingest_job(request, job_type):
+    """ Decode the payload up front so malformed requests are rejected before queueing """
+    session = SessionLocal()
+    try:
+        project_id = crud.get_project_id(session, request.project_name)
+        usfm = ingest.decode_usfm(request.encoded_usfm, job_type, project_id)
+        job_id = jobs.submit_job(session, job_type, request.project_name, request.usfm_sha, usfm)
+        return JSONResponse(
+            content={"message": "USFM file accepted for processing", "job_id": job_id, "status": "queued"},
+            status_code=202,
+            headers={"Location": f"/jobs/{job_id}"}
+        )
+    except HTTPException as e:
+        session.rollback()
+        raise e
+    except Exception as e:
+        logging.error(f"Error queueing {job_type} job: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+@router.post("/jobs/upload_usfm/", status_code=202)
+async def submit_upload_job(request: USFMUploadRequest):
+    """ Accept a USFM upload for background processing and return a job id to poll """
+    return _submit_ingest_job(request, "upload")
+
+
+@router.put("/jobs/update_usfm/", status_code=202)
+async def submit_update_job(request: USFMUploadRequest):
+    """ Accept a USFM update for background processing and return a job id to poll """
+    return _submit_ingest_job(request, "update")
+
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """ Report the status, current stage and any parse errors of an ingest job """
+    session = SessionLocal()
+    try:
+        job = session.get(IngestJob, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return jobs.job_to_dict(job)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching job {job_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
 @router.get("/list_books/")
 async def list_books(project_name: str = Query(None)):
     """ Retrieve all Bibles (projects) along with their books and their status, optionally filtering by project name """
@@ -306,7 +456,7 @@ async def list_books(project_name: str = Query(None)):
         bible_list = []
         for project in projects:
             books = session.query(Book).filter(Book.project_id == project.project_id).all()
-            book_data = [{"book_id": book.book_id, "book_name": book.book_name, "status": book.status , "usfm_sha": book.usfm_sha} for book in books] 
+            book_data = [{"book_id": book.book_id, "book_name": book.book_name, "status": book.status , "usfm_sha": book.usfm_sha, "revision": book.revision} for book in books] 
 
             bible_list.append({
                 "project_id": project.project_id,
@@ -334,18 +484,13 @@ async def find_missing_verses(book_name: str, project_name: str):
     session = SessionLocal()
 
     try:
-        # Load versification.json inside the function
-        VERSIFICATION_FILE = "versification.json"
-        try:
-            with open(VERSIFICATION_FILE, "r", encoding="utf-8") as f:
-                versification_data = json.load(f)
-                max_verses = versification_data.get("maxVerses", {})
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error loading versification.json: {e}")
+        if VERSIFICATION_ERROR:
+            raise HTTPException(status_code=500, detail=f"Error loading versification.json: {VERSIFICATION_ERROR}")
+        max_verses = MAX_VERSES
         # Get project_id from project_name
         project_id = crud.get_project_id(session,project_name)
         # Get book name from `books` table
-        book = session.query(Book).filter(Book.book_name == book_name, Book.project_id == project_id).first()
+        book = session.query(Book.book_id, Book.book_name).filter(Book.book_name == book_name, Book.project_id == project_id).first()
         book_id = book.book_id
         if not book:
             raise HTTPException(status_code=404, detail=f"Book ID {book_id} not found in project {project_id}")
@@ -354,6 +499,13 @@ async def find_missing_verses(book_name: str, project_name: str):
         if book_name not in max_verses:
             raise HTTPException(status_code=404, detail=f"Book '{book_name}' not found in versification.json")
 
+        if read_model.READ_MODEL_ENABLED:
+            missing_verses = [
+                {"chapter": chapter, "verse": verse}
+                for chapter, verse in read_model.missing_verses(read_model.get_book_verses(session, book_id), max_verses[book_name])
+            ]
+            return _missing_verses_response(missing_verses, project_id, project_name, book_name, book_id)
+
         # Get all existing verses for this book
         existing_verses = session.query(Verse.chapter, Verse.verse).filter(Verse.book_id == book_id).all()  #[(1, "1"), (1, "2"), (2, "1"), (2, "3")]
         # Convert to dict by chapter
@@ -378,18 +530,7 @@ async def find_missing_verses(book_name: str, project_name: str):
                 if verse not in existing_verse_dict.get(chapter, []):
                     missing_verses.append({"chapter": chapter, "verse": verse})
 
-        if not missing_verses:
-            return {"message": f"No missing verses found for {book_name} in project {project_id}"}
-
-        return {
-            "message": "Missing verses found.",
-            "project": project_id,
-            "project_name": project_name,
-            "book": book_name,
-            "book_id": book_id,           
-            "missing_count": len(missing_verses),
-            "missing_verses": missing_verses
-        }
+        return _missing_verses_response(missing_verses, project_id, project_name, book_name, book_id)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -398,6 +539,21 @@ async def find_missing_verses(book_name: str, project_name: str):
         session.close()
 
 
+def _missing_verses_response(missing_verses, project_id, project_name, book_name, book_id):
+    if not missing_verses:
+        return {"message": f"No missing verses found for {book_name} in project {project_id}"}
+
+    return {
+        "message": "Missing verses found.",
+        "project": project_id,
+        "project_name": project_name,
+        "book": book_name,
+        "book_id": book_id,           
+        "missing_count": len(missing_verses),
+        "missing_verses": missing_verses
+    }
+
+
 
 @router.get("/book/usfm/")
 async def get_book_usfm(project_name: str, book_name: str):
@@ -433,6 +589,50 @@ async def get_book_usfm(project_name: str, book_name: str):
 
 
 
+@router.get("/book/usj/")
+async def get_book_usj(project_name: str, book_name: str):
+    """
+    Get the stored USJ of a book, passed through as serialized by the database.
+    """
+    session = SessionLocal()
+    book_id = None
+    try:
+        book_id = crud.get_book_id(session, project_name, book_name)
+        usj_text = crud.get_book_usj_text(session, book_id)
+        if usj_text is None:
+            raise HTTPException(status_code=404, detail="USJ is not available for this book")
+        return Response(content=usj_text, media_type="application/json")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching USJ for book_id {book_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+@router.get("/chapter/usj/")
+async def get_chapter_usj(project_name: str, book_name: str, chapter: int):
+    """
+    Get the USJ of one chapter. The chapter is cut out of the stored USJ inside the database.
+    """
+    session = SessionLocal()
+    book_id = None
+    try:
+        book_id = crud.get_book_id(session, project_name, book_name)
+        usj_text = crud.get_chapter_usj_text(session, book_id, chapter)
+        if usj_text is None:
+            raise HTTPException(status_code=404, detail="USJ is not available for this chapter")
+        return Response(content=usj_text, media_type="application/json")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching USJ for book_id {book_id}, chapter {chapter}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
 @router.get("/book/json/")
 async def get_book_json(project_name: str, book_name: str):
     """
@@ -553,111 +753,96 @@ async def get_book_chapters(project_name: str, book_name: str):
 
 
 
+withbcv_exports = concurrency.HeavyEndpoint("/parallel_corpora/withbcv/")
+withoutbcv_exports = concurrency.HeavyEndpoint("/parallel_corpora/withoutbcv/")
+
+
 @router.get("/parallel_corpora/withbcv/")
 async def get_parallel_corpora_withbcv(
+    request: Request,
     project_name_1: str, 
     project_name_2: str, 
-    response_type: str = Query("csv", description="Set 'json' for JSON response, 'csv' for file download")
+    response_type: str = Query("csv", description="Set 'json' for JSON response, 'csv' for file download"),
+    exclude_duplicates: bool = Query(False, description="Leave out near-duplicate verses within each project"),
+    since: int = Query(None, ge=0, description="Only return changes since this revision, taken from the X-Revision header of an earlier export"),
+    quality: filters.QualityFilters = Depends()
 ):
     """
     Generate and return the parallel corpus between two projects (two languages) in CSV or JSON format.
     - Retains existing merged verses if both projects have them.
     - Merges split verses only if the other project has them merged.
     - Skips missing verses.
+    - Optionally skips near-duplicate verses, keeping the first occurrence.
+    - Optionally drops low quality pairs (token counts, length ratio, identical text, script);
+      the filter statistics are returned in the JSON body or the X-Filter-Stats header.
+    - Every export carries its revision in the X-Revision header; passing it back as `since`
+      returns only the pairs added, changed or removed after that export.
     - Response type controlled by query parameter.
+    - Identical requests in flight share one export; too many concurrent exports get 429.
     """
+    return await withbcv_exports.run(
+        concurrency.request_key(request), _export_withbcv,
+        project_name_1, project_name_2, response_type, exclude_duplicates, since, quality,
+    )
+
+
+def _export_withbcv(project_name_1, project_name_2, response_type, exclude_duplicates, since, quality):
+    """ Build the withbcv export; blocking, run in the threadpool by the endpoint """
     session = SessionLocal()
     try:
+        # Taken first, so nothing written while the export runs is missed by the next delta
+        revision = delta.current_revision(session)
+
         # Fetch project IDs from project names
         project_id_1 = crud.get_project_id(session,project_name_1)
         project_id_2 = crud.get_project_id(session,project_name_2)
 
-        # Fetch books for both projects
-        books_1 = session.query(Book).filter(Book.project_id == project_id_1).all()
-        books_2 = session.query(Book).filter(Book.project_id == project_id_2).all()
-
-        books_2_dict = {book.book_name: book.book_id for book in books_2}
-        common_books = [book for book in books_1 if book.book_name in books_2_dict]
-
-        if not common_books:
-            raise HTTPException(status_code=404, detail="No common books found between the two projects")
-
-        parallel_corpora = []
-
-        for book in common_books:
-            book_name = book.book_name
-            book_id_1 = book.book_id
-            book_id_2 = books_2_dict[book_name]
-
-            # get verses for book
-            verses_1_dict,merged_verses_1 = crud.get_verses(session, book_id_1)
-            verses_2_dict,merged_verses_2 = crud.get_verses(session, book_id_2)
-            
-            # Align split verses only when necessary
-            final_verses_1 = verses_1_dict.copy()
-            final_verses_2 = verses_2_dict.copy()
-
-            # Preserve existing merged verses if both projects have them
-            for (chapter, merged_verse), merged_text in merged_verses_1.items():
-                if (chapter, merged_verse) in merged_verses_2:
-                    # Both projects have the same merged verse, retain them
-                    final_verses_1[(chapter, merged_verse)] = merged_text
-                    final_verses_2[(chapter, merged_verse)] = merged_verses_2[(chapter, merged_verse)]
-                else:
-                    # Merge split verses from Project 2
-                    merged_text_2 = crud.get_merged_verse(merged_verse, verses_2_dict,chapter)
-                    final_verses_1[(chapter, merged_verse)] = merged_text
-                    final_verses_2[(chapter, merged_verse)] = merged_text_2 if merged_text_2 else None
-
-            for (chapter, merged_verse), merged_text in merged_verses_2.items():
-                if (chapter, merged_verse) in merged_verses_1:
-                    continue  # Already handled
-                # Merge split verses from Project 1
-                merged_text_1 = crud.get_merged_verse(merged_verse, verses_1_dict,chapter)
-                final_verses_2[(chapter, merged_verse)] = merged_text
-                final_verses_1[(chapter, merged_verse)] = merged_text_1 if merged_text_1 else None
-
-            # Get all unique chapter-verse pairs and sort them
-            all_keys = sorted(
-                set(final_verses_1.keys()) | set(final_verses_2.keys()),
-                key=lambda x: (int(x[0]), int(x[1].split("-")[0]) if "-" in x[1] else int(x[1]))
+        skip_keys_1, skip_keys_2 = _duplicate_keys(session, project_id_1, project_id_2, exclude_duplicates)
+        if since is not None:
+            return _parallel_delta_response(
+                session, (project_name_1, project_name_2), (project_id_1, project_id_2), since, revision,
+                response_type, quality, (skip_keys_1, skip_keys_2),
             )
-
-            for chapter, verse in all_keys:
-                text_1 = final_verses_1.get((chapter, verse))
-                text_2 = final_verses_2.get((chapter, verse))
-
-                # Skip missing verses
-                if text_1 is None or text_2 is None:
-                    continue
-
-                parallel_corpora.append({
-                    "book": book_name,
-                    "chapter": chapter,
-                    "verse": verse,
-                    project_name_1: text_1,
-                    project_name_2: text_2
-                })
+        rows = crud.build_parallel_corpora(session, project_id_1, project_id_2, "export_bcv", skip_keys_1, skip_keys_2)
+        rows, filter_stats = _apply_quality_filters(rows, quality, "export_bcv")
+        parallel_corpora = [
+            {
+                "book": book_name,
+                "chapter": chapter,
+                "verse": verse,
+                project_name_1: text_1,
+                project_name_2: text_2
+            }
+            for book_name, chapter, verse, text_1, text_2 in rows
+        ]
 
         if not parallel_corpora:
             raise HTTPException(status_code=404, detail="No parallel corpus data found")
 
         # Return JSON response if requested
         if response_type.lower() == "json":
+            content = {"parallel_corpora": parallel_corpora}
+            if filter_stats:
+                content["filter_stats"] = filter_stats
             return JSONResponse(
-                content={"parallel_corpora": parallel_corpora},
-                status_code=200
+                content=content,
+                status_code=200,
+                headers={"X-Revision": str(revision)}
             )
 
         # Create CSV in memory
-        output = crud.create_csv(project_name_1,project_name_2, parallel_corpora,True)
+        with stage("export_bcv", "serialize", rows=len(parallel_corpora)):
+            output = crud.create_csv(project_name_1,project_name_2, parallel_corpora,True)
         
-        return StreamingResponse(
-            iter([output.getvalue()]),
+        # A complete body rather than a stream, so a coalesced response can be sent to every waiting request
+        return Response(
+            content=output.getvalue(),
             media_type="text/csv",
             headers={
                 "Content-Disposition": 'attachment; filename="'+project_name_1 + "-" + project_name_2+'_bcv.csv"',
                 "Content-Type": "application/octet-stream",  # Forces download
+                "X-Revision": str(revision),
+                **_filter_stats_header(filter_stats),
             }
         )
 
@@ -675,94 +860,63 @@ async def get_parallel_corpora_withbcv(
 
 
 @router.get("/parallel_corpora/withoutbcv/")
-async def get_parallel_corpora_texts(project_name_1: str, project_name_2: str,
-                                         response_type: str = Query("csv", description="Set 'json' for JSON response, 'csv' for file download")):
+async def get_parallel_corpora_texts(request: Request, project_name_1: str, project_name_2: str,
+                                         response_type: str = Query("csv", description="Set 'json' for JSON response, 'csv' for file download"),
+                                         exclude_duplicates: bool = Query(False, description="Leave out near-duplicate verses within each project"),
+                                         quality: filters.QualityFilters = Depends()):
     """
     Generate and return the parallel corpus between two projects in CSV format with only Text_1 and Text_2.
+    Identical requests in flight share one export; too many concurrent exports get 429.
     """
+    return await withoutbcv_exports.run(
+        concurrency.request_key(request), _export_withoutbcv,
+        project_name_1, project_name_2, response_type, exclude_duplicates, quality,
+    )
+
+
+def _export_withoutbcv(project_name_1, project_name_2, response_type, exclude_duplicates, quality):
+    """ Build the withoutbcv export; blocking, run in the threadpool by the endpoint """
     session = SessionLocal()
     try:
         # Fetch project IDs from project names
         project_id_1 = crud.get_project_id(session,project_name_1)
         project_id_2 = crud.get_project_id(session,project_name_2)
 
-        # Fetch books for both projects
-        books_1 = session.query(Book).filter(Book.project_id == project_id_1).all()
-        books_2 = session.query(Book).filter(Book.project_id == project_id_2).all()
-
-        books_2_dict = {book.book_name: book.book_id for book in books_2}
-        common_books = [book for book in books_1 if book.book_name in books_2_dict]
-
-        if not common_books:
-            raise HTTPException(status_code=404, detail="No common books found between the two projects")
-
-        parallel_corpora = []
-
-        for book in common_books:
-            book_id_1 = book.book_id
-            book_id_2 = books_2_dict[book.book_name]
-
-            # get verses for book
-            verses_1_dict,merged_verses_1 = crud.get_verses(session, book_id_1)
-            verses_2_dict,merged_verses_2 = crud.get_verses(session, book_id_2)
-
-            final_verses_1 = verses_1_dict.copy()
-            final_verses_2 = verses_2_dict.copy()
-
-            # Preserve existing merged verses if both projects have them
-            for (chapter, merged_verse), merged_text in merged_verses_1.items():
-                if (chapter, merged_verse) in merged_verses_2:
-                    final_verses_1[(chapter, merged_verse)] = merged_text
-                    final_verses_2[(chapter, merged_verse)] = merged_verses_2[(chapter, merged_verse)]
-                else:
-                    merged_text_2 = crud.get_merged_verse(merged_verse, verses_2_dict,chapter)
-                    final_verses_1[(chapter, merged_verse)] = merged_text
-                    final_verses_2[(chapter, merged_verse)] = merged_text_2
-
-            for (chapter, merged_verse), merged_text in merged_verses_2.items():
-                if (chapter, merged_verse) in merged_verses_1:
-                    continue  
-                merged_text_1 = crud.get_merged_verse(merged_verse, verses_1_dict,chapter)
-                final_verses_2[(chapter, merged_verse)] = merged_text
-                final_verses_1[(chapter, merged_verse)] = merged_text_1
-
-            # Get all unique chapter-verse pairs and sort them
-            all_keys = sorted(
-                set(final_verses_1.keys()) | set(final_verses_2.keys()),
-                key=lambda x: (int(x[0]), int(x[1].split("-")[0]) if "-" in x[1] else int(x[1]))
-            )
-
-            for chapter, verse in all_keys:
-                text_1 = final_verses_1.get((chapter, verse))
-                text_2 = final_verses_2.get((chapter, verse))
-
-                if text_1 is None or text_2 is None:
-                    continue
-
-                parallel_corpora.append({
-                    project_name_1: text_1,
-                    project_name_2: text_2
-                })
+        skip_keys_1, skip_keys_2 = _duplicate_keys(session, project_id_1, project_id_2, exclude_duplicates)
+        rows = crud.build_parallel_corpora(session, project_id_1, project_id_2, "export_text", skip_keys_1, skip_keys_2)
+        rows, filter_stats = _apply_quality_filters(rows, quality, "export_text")
+        parallel_corpora = [
+            {
+                project_name_1: text_1,
+                project_name_2: text_2
+            }
+            for _, _, _, text_1, text_2 in rows
+        ]
 
         if not parallel_corpora :
             raise HTTPException(status_code=404, detail="No parallel corpus data found")
         
         # Return JSON response if requested
         if response_type.lower() == "json":
+            content = {"parallel_corpora": parallel_corpora}
+            if filter_stats:
+                content["filter_stats"] = filter_stats
             return JSONResponse(
-                content={"parallel_corpora": parallel_corpora},
+                content=content,
                 status_code=200
             )
 
         # Create CSV in memory
-        output = crud.create_csv(project_name_1,project_name_2, parallel_corpora,False)
+        with stage("export_text", "serialize", rows=len(parallel_corpora)):
+            output = crud.create_csv(project_name_1,project_name_2, parallel_corpora,False)
         
-        return StreamingResponse(
-            iter([output.getvalue()]),
+        return Response(
+            content=output.getvalue(),
             media_type="text/csv",
             headers={
                 "Content-Disposition": 'attachment; filename="'+project_name_1 + "-" + project_name_2+'.csv"',
                 "Content-Type": "application/octet-stream",  # Forces download
+                **_filter_stats_header(filter_stats),
             }
         )
 
@@ -777,3 +931,292 @@ async def get_parallel_corpora_texts(project_name_1: str, project_name_2: str,
 
     finally:
         session.close()
+
+
+training_exports = concurrency.HeavyEndpoint("/parallel_corpora/training/")
+
+
+@router.get("/parallel_corpora/training/")
+async def get_training_set(
+    request: Request,
+    project_name_1: str,
+    project_name_2: str,
+    splits: str = Query(training_export.DEFAULT_SPLITS, description="Split names and ratios adding up to 1"),
+    seed: int = Query(0, description="Seed of the split assignment; the same seed keeps every verse in the same split"),
+    shard_rows: int = Query(10000, ge=1, description="Maximum rows per shard"),
+    output_dir: str = Query(None, description="Write to this directory below TRAINING_EXPORT_ROOT on the server instead of returning a tar archive"),
+    exclude_duplicates: bool = Query(False, description="Leave out near-duplicate verses within each project"),
+    quality: filters.QualityFilters = Depends()
+):
+    """
+    Export the parallel corpus (aligned like /parallel_corpora/withbcv/) as train/dev/test splits of
+    gzipped CSV shards plus a manifest.json with row counts and SHA-256 checksums.
+    - Each verse goes to a split by a hash of (seed, book, chapter, verse), so splits stay stable across re-exports.
+    - Shards are written in parallel by a pool of worker threads.
+    - Returns an uncompressed tar of manifest.json and the shards, or with output_dir writes them
+      to that server directory and returns the manifest.
+    - Identical requests in flight share one export; too many concurrent exports get 429.
+    """
+    split_ratios = training_export.parse_splits(splits)
+    return await training_exports.run(
+        concurrency.request_key(request), _export_training_set,
+        project_name_1, project_name_2, split_ratios, seed, shard_rows, output_dir, exclude_duplicates, quality,
+    )
+
+
+def _export_training_set(project_name_1, project_name_2, splits, seed, shard_rows, output_dir, exclude_duplicates, quality):
+    """ Build the training set export; blocking, run in the threadpool by the endpoint """
+    session = SessionLocal()
+    try:
+        revision = delta.current_revision(session)
+        project_id_1 = crud.get_project_id(session, project_name_1)
+        project_id_2 = crud.get_project_id(session, project_name_2)
+
+        skip_keys_1, skip_keys_2 = _duplicate_keys(session, project_id_1, project_id_2, exclude_duplicates)
+        rows = crud.build_parallel_corpora(session, project_id_1, project_id_2, "export_training", skip_keys_1, skip_keys_2)
+        rows, filter_stats = _apply_quality_filters(rows, quality, "export_training")
+        if not rows:
+            raise HTTPException(status_code=404, detail="No parallel corpus data found")
+        # Only the DB work needs the connection; splitting and writing the shards does not
+        session.close()
+
+        extra = {"exclude_duplicates": exclude_duplicates, "filters": quality.model_dump(exclude_defaults=True)}
+        if filter_stats:
+            extra["filter_stats"] = filter_stats
+        manifest, archive = training_export.export_training_set(
+            rows, (project_name_1, project_name_2), splits, seed, shard_rows, revision, output_dir, extra,
+        )
+
+        if output_dir is not None:
+            return JSONResponse(
+                content={"message": "Training set exported", "output_dir": output_dir, "manifest": manifest},
+                status_code=200,
+                headers={"X-Revision": str(revision), **_filter_stats_header(filter_stats)},
+            )
+
+        # Coalesced requests each send the same archive file, which is removed after the last one
+        return concurrency.SharedFile(
+            archive, os.path.dirname(archive),
+            media_type="application/x-tar",
+            filename=f"{project_name_1}-{project_name_2}_training_seed{seed}.tar",
+            headers={"X-Revision": str(revision), **_filter_stats_header(filter_stats)},
+        )
+
+    except HTTPException as e:
+        session.rollback()
+        raise e
+
+    except Exception as e:
+        logging.error(f"Error generating training set: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+    finally:
+        session.close()
+
+
+def _apply_quality_filters(rows, quality, pipeline):
+    if not quality.active():
+        return rows, None
+    with stage(pipeline, "filter", rows=len(rows)):
+        return filters.filter_pairs(rows, quality)
+
+
+def _filter_stats_header(filter_stats):
+    return {"X-Filter-Stats": json.dumps(filter_stats)} if filter_stats else {}
+
+
+def _parallel_delta_response(session, project_names, project_ids, since, revision, response_type, quality, skip_keys):
+    """ The withbcv export restricted to changes since a revision, with removed pairs listed separately """
+    project_name_1, project_name_2 = project_names
+    upserts, removed = delta.build_parallel_delta(session, *project_ids, since, "export_delta", *skip_keys)
+    kept, filter_stats = _apply_quality_filters(upserts, quality, "export_delta")
+    if filter_stats:
+        removed = delta.drop_filtered(upserts, kept, removed)
+    logging.info(f"Delta export {project_name_1}-{project_name_2} since revision {since}: {len(kept)} upserts, {len(removed)} removed")
+
+    if response_type.lower() == "json":
+        content = {
+            "parallel_corpora": [
+                {"book": book_name, "chapter": chapter, "verse": verse, project_name_1: text_1, project_name_2: text_2}
+                for book_name, chapter, verse, text_1, text_2 in kept
+            ],
+            "removed": [{"book": book_name, "chapter": chapter, "verse": verse} for book_name, chapter, verse in removed],
+            "since": since,
+            "revision": revision,
+        }
+        if filter_stats:
+            content["filter_stats"] = filter_stats
+        return JSONResponse(content=content, status_code=200, headers={"X-Revision": str(revision)})
+
+    with stage("export_delta", "serialize", rows=len(kept) + len(removed)):
+        output = delta.create_delta_csv(project_name_1, project_name_2, kept, removed)
+    return Response(
+        content=output.getvalue(),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": f'attachment; filename="{project_name_1}-{project_name_2}_bcv_since_{since}.csv"',
+            "Content-Type": "application/octet-stream",
+            "X-Revision": str(revision),
+            **_filter_stats_header(filter_stats),
+        }
+    )
+
+
+def _duplicate_keys(session, project_id_1, project_id_2, exclude_duplicates):
+    if not exclude_duplicates:
+        return set(), set()
+    with stage("export", "find_duplicates"):
+        return dedup.duplicate_verse_keys(session, project_id_1), dedup.duplicate_verse_keys(session, project_id_2)
+
+
+@router.post("/dedup/index/")
+async def index_duplicates(project_name: str = Query(None)):
+    """ Compute MinHash signatures for verses that do not have one yet, for one project or all projects """
+    session = SessionLocal()
+    try:
+        project_id = crud.get_project_id(session, project_name) if project_name else None
+        with stage("dedup", "index", project_id=project_id):
+            indexed = dedup.index_verses(session, project_id)
+        return {"message": "Verse signatures are up to date", "indexed_verses": indexed}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error indexing verse signatures: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+@router.get("/dedup/clusters/")
+async def get_duplicate_clusters(
+    project_name: str,
+    across_projects: bool = Query(False, description="Also match verses from other projects"),
+    threshold: float = Query(dedup.DEFAULT_THRESHOLD, gt=0, le=1, description="Minimum estimated Jaccard similarity")
+):
+    """
+    Report clusters of duplicate and near-duplicate verses in a project,
+    optionally including matching verses from other projects.
+    """
+    session = SessionLocal()
+    try:
+        project_id = crud.get_project_id(session, project_name)
+        with stage("dedup", "clusters", project_id=project_id):
+            clusters = dedup.find_clusters(session, project_id, across_projects, threshold)
+        return {
+            "project_name": project_name,
+            "across_projects": across_projects,
+            "threshold": threshold,
+            "cluster_count": len(clusters),
+            "clusters": clusters
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error finding duplicate verses for {project_name}: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+@router.get("/search/")
+async def search_verses(
+    query: str,
+    project_name: str = Query(None),
+    book_name: str = Query(None),
+    chapter: int = Query(None),
+    mode: str = Query("fulltext", description="'fulltext' for word matches, 'fuzzy' for trigram similarity"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100)
+):
+    """
+    Search verse text across projects, optionally filtered by project, book and chapter.
+    Results are ranked by relevance and paginated.
+    """
+    session = SessionLocal()
+    try:
+        query = query.strip()
+        if not query:
+            raise HTTPException(status_code=400, detail="Search query cannot be empty")
+        mode = mode.lower()
+        if mode not in ("fulltext", "fuzzy"):
+            raise HTTPException(status_code=400, detail="mode must be 'fulltext' or 'fuzzy'")
+        if mode == "fuzzy" and not crud.trigram_available(session):
+            raise HTTPException(status_code=400, detail="Fuzzy search is not available on this server")
+
+        project_id = crud.get_project_id(session, project_name) if project_name else None
+        total, rows = crud.search_verses(
+            session, query, mode, project_id, book_name, chapter,
+            offset=(page - 1) * page_size, limit=page_size
+        )
+        return {
+            "query": query,
+            "mode": mode,
+            "page": page,
+            "page_size": page_size,
+            # null when there are more than SEARCH_COUNT_LIMIT matches
+            "total": total,
+            "results": [
+                {
+                    "project_name": row.project_name,
+                    "book": row.book_name,
+                    "chapter": row.chapter,
+                    "verse": row.verse,
+                    "text": row.text,
+                    "rank": round(float(row.rank), 6)
+                }
+                for row in rows
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error searching verses for '{query}': {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
+
+
+@router.get("/stats/")
+async def get_corpus_stats(project_name: str, book_name: str = Query(None)):
+    """
+    Verse, token and character counts and vocabulary size of a project and each of its books.
+    The numbers are maintained at ingest, so no verses are scanned here.
+    """
+    session = SessionLocal()
+    try:
+        project_id = crud.get_project_id(session, project_name)
+        corpus_stats.ensure_project_stats(session, project_id)
+
+        books = (
+            session.query(Book.book_id, Book.book_name, BookStats)
+            .outerjoin(BookStats, BookStats.book_id == Book.book_id)
+            .filter(Book.project_id == project_id)
+            .order_by(Book.book_id)
+        )
+        if book_name:
+            books = books.filter(Book.book_name == book_name)
+        books = books.all()
+        if book_name and not books:
+            raise HTTPException(status_code=404, detail="Book not found")
+
+        project_stats = session.get(ProjectStats, project_id)
+        return {
+            "project_name": project_name,
+            "project_id": project_id,
+            **corpus_stats.stats_to_dict(project_stats),
+            "books": [
+                {"book_id": book_id, "book_name": name, **corpus_stats.stats_to_dict(stats)}
+                for book_id, name, stats in books
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching statistics for {project_name}: {str(e)}")
+        session.rollback()
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        session.close()
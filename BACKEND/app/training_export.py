@@ -0,0 +1,211 @@
+import io
+import os
+import re
+import csv
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from metrics import stage
+
+
+# Train/dev/test exports of a parallel corpus as gzipped CSV shards. Every row goes to a split by
+# a hash of (seed, book, chapter, verse) alone, so a verse stays in the same split across
+# re-exports, whatever else was added, removed or filtered out.
+MANIFEST_FORMAT = 1
+DEFAULT_SPLITS = "train=0.98,dev=0.01,test=0.01"
+SPLIT_HASH = "blake2b-64('seed:book:chapter:verse') / 2**64"
+# Shards are compressed and hashed in threads; zlib and hashlib release the GIL for that work
+EXPORT_WORKERS = int(os.environ.get("TRAINING_EXPORT_WORKERS", str(min(os.cpu_count() or 1, 4))))
+# Directory output is only allowed below this root and is off when it is not set
+EXPORT_ROOT = os.environ.get("TRAINING_EXPORT_ROOT")
+
+ARCHIVE_NAME = "training.tar"
+COPY_CHUNK_BYTES = 1024 * 1024
+
+SPLIT_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+def parse_splits(spec):
+    """ 'train=0.98,dev=0.01,test=0.01' -> [(name, ratio), ...]; the ratios must add up to 1 """
+    splits = []
+    for part in spec.split(","):
+        name, _, ratio = part.partition("=")
+        name = name.strip()
+        if not SPLIT_NAME.match(name) or name in dict(splits):
+            raise HTTPException(status_code=400, detail=f"Invalid or repeated split name '{name}' in '{spec}'")
+        try:
+            ratio = float(ratio)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid ratio for split '{name}' in '{spec}'")
+        if not 0 < ratio <= 1:
+            raise HTTPException(status_code=400, detail=f"Ratio of split '{name}' must be in (0, 1]")
+        splits.append((name, ratio))
+    if abs(sum(ratio for _, ratio in splits) - 1) > 1e-6:
+        raise HTTPException(status_code=400, detail=f"Split ratios must add up to 1, got {sum(ratio for _, ratio in splits):g}")
+    return splits
+
+
+def split_point(seed, book_name, chapter, verse):
+    """ Position of a verse in [0, 1), the same on every export with the same seed """
+    digest = hashlib.blake2b(f"{seed}:{book_name}:{chapter}:{verse}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
+
+
+def assign_splits(rows, splits, seed):
+    """ {split name: rows} for (book_name, chapter, verse, text_1, text_2) rows, keeping their order """
+    bounds = []
+    total = 0.0
+    for name, ratio in splits:
+        total += ratio
+        bounds.append((total, name))
+    assigned = {name: [] for name, _ in splits}
+    for row in rows:
+        point = split_point(seed, row[0], row[1], row[2])
+        # The last split also takes what rounding of the bounds leaves over
+        name = next((name for bound, name in bounds if point < bound), bounds[-1][1])
+        assigned[name].append(row)
+    return assigned
+
+
+def shard_name(split, index, count):
+    return f"{split}-{index:05d}-of-{count:05d}.csv.gz"
+
+
+def _write_shard(name, split, index, header, rows, directory):
+    """
+    Serialize, compress and hash one shard into directory; the gzip header carries no timestamp,
+    so unchanged rows give an identical file and checksum.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    writer.writerows(rows)
+    data = gzip.compress(output.getvalue().encode("utf-8"), mtime=0)
+    with open(os.path.join(directory, name), "wb") as f:
+        f.write(data)
+    return {"file": name, "split": split, "index": index, "rows": len(rows), "bytes": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def build_shards(assigned, header, shard_rows, directory, workers=EXPORT_WORKERS):
+    """
+    Cut every split into shards of at most shard_rows rows, in row order, and write them to
+    directory with a pool of worker threads. Returns the manifest entries in shard order.
+    """
+    jobs = []
+    for split, rows in assigned.items():
+        count = -(-len(rows) // shard_rows)
+        for index in range(count):
+            chunk = rows[index * shard_rows:(index + 1) * shard_rows]
+            jobs.append((shard_name(split, index, count), split, index, header, chunk, directory))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(lambda job: _write_shard(*job), jobs))
+
+
+def output_directory(output_dir):
+    """ Absolute path for output_dir below TRAINING_EXPORT_ROOT; it must not exist yet """
+    if not EXPORT_ROOT:
+        raise HTTPException(status_code=400, detail="Directory output is disabled; set TRAINING_EXPORT_ROOT on the server")
+    root = os.path.realpath(EXPORT_ROOT)
+    target = os.path.realpath(os.path.join(root, output_dir))
+    if os.path.isabs(output_dir) or target == root or os.path.commonpath([root, target]) != root:
+        raise HTTPException(status_code=400, detail=f"output_dir must be a relative path inside the export root, got '{output_dir}'")
+    if os.path.exists(target):
+        raise HTTPException(status_code=409, detail=f"Output directory '{output_dir}' already exists")
+    return target
+
+
+def export_training_set(rows, project_names, splits, seed, shard_rows, revision, output_dir=None, extra=None):
+    """
+    Split and shard (book_name, chapter, verse, text_1, text_2) rows.
+    With output_dir the shards and manifest.json are written to that directory below the export
+    root, which appears complete or not at all; otherwise they are archived into a tar file in a
+    new temporary directory, which the caller removes.
+    extra is added to the manifest (export settings and filter statistics).
+    Returns the manifest and the path of the archive (None for directory output).
+    """
+    project_name_1, project_name_2 = project_names
+    target = output_directory(output_dir) if output_dir is not None else None
+
+    with stage("export_training", "split", rows=len(rows)):
+        assigned = assign_splits(rows, splits, seed)
+
+    header = ["Book", "Chapter", "Verse", project_name_1, project_name_2]
+    archive = None
+    if target is not None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".training-", dir=os.path.dirname(target))
+    else:
+        staging = tempfile.mkdtemp(prefix="training-export-")
+    try:
+        with stage("export_training", "write_shards", rows=len(rows)):
+            shards = build_shards(assigned, header, shard_rows, staging)
+
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "projects": [project_name_1, project_name_2],
+            "revision": revision,
+            "seed": seed,
+            "splits": dict(splits),
+            "split_hash": SPLIT_HASH,
+            "shard_rows": shard_rows,
+            **(extra or {}),
+            "columns": header,
+            "rows": len(rows),
+            "counts": {split: len(split_rows) for split, split_rows in assigned.items()},
+            "shards": shards,
+        }
+        if target is not None:
+            with open(os.path.join(staging, "manifest.json"), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            try:
+                os.rename(staging, target)
+            except OSError:
+                raise HTTPException(status_code=409, detail=f"Output directory '{output_dir}' already exists")
+        else:
+            with stage("export_training", "archive", shards=len(shards)):
+                archive = os.path.join(staging, ARCHIVE_NAME)
+                with open(archive, "wb") as f:
+                    f.writelines(iter_tar(manifest, staging))
+            # The archive holds a copy of every shard
+            for shard in shards:
+                os.remove(os.path.join(staging, shard["file"]))
+        staging = None
+    finally:
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    counts = ", ".join(f"{split}={count}" for split, count in manifest["counts"].items())
+    logging.info(f"Training export {project_name_1}-{project_name_2}: {len(rows)} rows ({counts}) in {len(shards)} shards")
+    return manifest, archive
+
+
+def iter_tar(manifest, directory):
+    """
+    An uncompressed tar of manifest.json and the (already gzipped) shards in directory, block by
+    block. Members carry mtime 0, so an unchanged corpus gives a byte-identical archive.
+    """
+    body = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+    members = [("manifest.json", len(body), None)] + [(shard["file"], shard["bytes"], os.path.join(directory, shard["file"])) for shard in manifest["shards"]]
+    for name, size, path in members:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = 0
+        yield info.tobuf(tarfile.PAX_FORMAT)
+        if path is None:
+            yield body
+        else:
+            with open(path, "rb") as f:
+                while chunk := f.read(COPY_CHUNK_BYTES):
+                    yield chunk
+        if size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+    # End-of-archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
@@ -0,0 +1,103 @@
+"""
+Peak memory check for the upload pipeline.
+
+Builds a synthetic USFM book of the requested size, runs it through ingest.upload_book
+against the configured database (HACKATHON_POSTGRES_* variables) under tracemalloc and
+fails if the peak Python allocation exceeds --max-ratio times the size of the input.
+The book and its scratch project are removed afterwards.
+
+    python benchmarks/ingest_memory.py --size-mb 5 --max-ratio 14
+"""
+import os
+import sys
+import argparse
+import hashlib
+import logging
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import database  # noqa: E402
+import ingest  # noqa: E402
+from db_models import Project, Book, Verse, ProjectStats, ProjectVocabulary  # noqa: E402
+
+
+WORDS = ["आदि", "में", "वचन", "था", "and", "the", "Word", "was", "with", "God", "“light”", "darkness"]
+
+
+def synthetic_usfm(size_bytes, book_name="JHN"):
+    """ A book with 30-verse chapters of mixed-script text, grown until it reaches size_bytes """
+    lines = [f"\\id {book_name} memory check", "\\h Memory Check", "\\mt Memory Check"]
+    size = sum(len(line.encode("utf-8")) + 1 for line in lines)
+    chapter = 0
+    while size < size_bytes:
+        chapter += 1
+        lines += [f"\\c {chapter}", "\\p"]
+        for verse in range(1, 31):
+            text = " ".join(WORDS[(chapter * 7 + verse * 3 + i) % len(WORDS)] for i in range(24))
+            lines.append(f"\\v {verse} {text} {chapter}:{verse}.")
+        size = sum(len(line.encode("utf-8")) + 1 for line in lines)
+    return "\n".join(lines) + "\n"
+
+
+def remove_project(session, project_name):
+    project = session.query(Project).filter(Project.project_name == project_name).first()
+    if not project:
+        return
+    book_ids = [book_id for (book_id,) in session.query(Book.book_id).filter(Book.project_id == project.project_id)]
+    if book_ids:
+        session.query(Verse).filter(Verse.book_id.in_(book_ids)).delete(synchronize_session=False)
+        session.query(Book).filter(Book.book_id.in_(book_ids)).delete(synchronize_session=False)
+    session.query(ProjectVocabulary).filter(ProjectVocabulary.project_id == project.project_id).delete()
+    session.query(ProjectStats).filter(ProjectStats.project_id == project.project_id).delete()
+    session.delete(project)
+    session.commit()
+
+
+def measure(size_bytes, project_name):
+    """ Upload a synthetic book and return (input bytes, peak traced bytes, verse count) """
+    usfm = synthetic_usfm(size_bytes)
+    input_bytes = len(usfm.encode("utf-8"))
+    usfm_sha = hashlib.sha256(usfm.encode("utf-8")).hexdigest()
+
+    session = database.SessionLocal()
+    try:
+        remove_project(session, project_name)
+        project = Project(project_name=project_name)
+        session.add(project)
+        session.commit()
+        project_id = project.project_id
+
+        tracemalloc.start()
+        try:
+            # The caller's copy was allocated before tracing started, so only pipeline allocations count
+            book_id = ingest.upload_book(session, project_id, usfm, usfm_sha)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        verse_count = session.query(Verse).filter(Verse.book_id == book_id).count()
+        return input_bytes, peak, verse_count
+    finally:
+        session.rollback()
+        remove_project(session, project_name)
+        session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check peak memory of a USFM upload against its input size")
+    parser.add_argument("--size-mb", type=float, default=2, help="size of the synthetic USFM book (default: 2)")
+    parser.add_argument("--max-ratio", type=float, default=14, help="allowed peak allocation as a multiple of the input size")
+    parser.add_argument("--project", default="__ingest_memory_check__", help="scratch project name, removed afterwards")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    database.init_db()
+    input_bytes, peak, verse_count = measure(int(args.size_mb * 1024 * 1024), args.project)
+    ratio = peak / input_bytes
+    print(f"input={input_bytes / 1e6:.2f}MB verses={verse_count} peak={peak / 1e6:.2f}MB ratio={ratio:.1f}x (max {args.max_ratio}x)")
+    return 0 if ratio <= args.max_ratio else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+"""
+Load test for the API with throughput and latency percentiles per endpoint.
+
+Seeds synthetic projects (created once and reused by later runs), then runs --concurrency
+virtual users for --duration seconds. Each user repeatedly picks an endpoint from the
+weighted --mix and calls it. Reports requests, errors, 429 rejections, throughput and
+p50/p95/p99 latency per endpoint.
+
+Without --base-url the app is driven in process through httpx's ASGI transport against the
+configured database (HACKATHON_POSTGRES_* variables). Handlers then share the event loop
+with the load generator, so use --base-url against a running server (e.g. uvicorn or
+gunicorn with several workers) for capacity numbers.
+
+    python benchmarks/load_test.py --concurrency 32 --duration 60 \\
+        --mix chapter=60,list_books=20,upload=5,withbcv=10,withoutbcv=5
+
+Requires httpx. Uploads go to scratch projects; --cleanup removes every project whose
+name starts with --prefix from the configured database afterwards.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import httpx  # noqa: E402
+
+
+BOOKS = (
+    "GEN EXO LEV NUM DEU JOS JDG RUT 1SA 2SA 1KI 2KI 1CH 2CH EZR NEH EST JOB PSA PRO ECC SNG "
+    "ISA JER LAM EZK DAN HOS JOL AMO OBA JON MIC NAM HAB ZEP HAG ZEC MAL MAT MRK LUK JHN ACT "
+    "ROM 1CO 2CO GAL EPH PHP COL 1TH 2TH 1TI 2TI TIT PHM HEB JAS 1PE 2PE 1JN 2JN 3JN JUD REV"
+).split()
+WORDS = {
+    0: ["in", "the", "beginning", "was", "the", "Word", "and", "light", "shines", "in", "darkness", "“truth”"],
+    1: ["आदि", "में", "वचन", "था", "और", "ज्योति", "अन्धकार", "में", "चमकती", "है", "“सत्य”", "जीवन"],
+}
+ENDPOINTS = ("chapter", "list_books", "upload", "withbcv", "withoutbcv")
+DEFAULT_MIX = "chapter=60,list_books=20,upload=5,withbcv=10,withoutbcv=5"
+
+
+def synthetic_book(book_name, chapters, verses, language, merged=False):
+    """ USFM for a book; with merged, verses 2-3 of every chapter are one merged verse """
+    words = WORDS[language % len(WORDS)]
+    lines = [f"\\id {book_name} load test", "\\h Load Test", "\\mt Load Test"]
+    for chapter in range(1, chapters + 1):
+        lines += [f"\\c {chapter}", "\\p"]
+        verse = 1
+        while verse <= verses:
+            text = " ".join(words[(chapter * 5 + verse * 3 + i) % len(words)] for i in range(16))
+            if merged and verse == 2:
+                lines.append(f"\\v 2-3 {text} {chapter}:2-3.")
+                verse = 4
+                continue
+            lines.append(f"\\v {verse} {text} {chapter}:{verse}.")
+            verse += 1
+    return "\n".join(lines) + "\n"
+
+
+def upload_payload(project_name, usfm):
+    data = usfm.encode("utf-8")
+    return {
+        "project_name": project_name,
+        "usfm_sha": hashlib.sha256(data).hexdigest(),
+        "encoded_usfm": base64.b64encode(data).decode("ascii"),
+    }
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted list """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint '{name.strip()}' in --mix, choose from {', '.join(ENDPOINTS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+class LoadTest:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.projects = [f"{args.prefix}{i}" for i in range(max(args.projects, 2))]
+        self.books = BOOKS[:args.books]
+        self.samples = {name: [] for name in ENDPOINTS}
+        self.statuses = {name: {} for name in ENDPOINTS}
+        self.uploads = 0
+        self.run_tag = int(time.time())
+        self.upload_projects = set()
+        self.upload_lock = asyncio.Lock()
+
+    async def seed(self):
+        """ Create the read projects with their books unless an earlier run already did """
+        for index, project_name in enumerate(self.projects):
+            response = await self.client.get("/list_books/", params={"project_name": project_name})
+            existing = set()
+            if response.status_code == 200:
+                existing = {book["book_name"] for book in response.json()["bibles"][0]["books"]}
+            else:
+                await self.client.post("/add_project/", json={"project_name": project_name})
+            for book_name in self.books:
+                if book_name in existing:
+                    continue
+                usfm = synthetic_book(book_name, self.args.chapters, self.args.verses, index, merged=index % 2 == 1)
+                response = await self.client.post("/upload_usfm/", json=upload_payload(project_name, usfm))
+                if response.status_code != 200:
+                    raise SystemExit(f"Seeding {project_name}/{book_name} failed: {response.status_code} {response.text}")
+            print(f"Seeded {project_name} with {len(self.books)} books")
+
+    async def chapter(self):
+        return await self.client.get("/chapter/json/", params={
+            "project_name": self.rng.choice(self.projects),
+            "book_name": self.rng.choice(self.books),
+            "chapter": self.rng.randint(1, self.args.chapters),
+        })
+
+    async def list_books(self):
+        return await self.client.get("/list_books/", params={"project_name": self.rng.choice(self.projects)})
+
+    async def upload(self):
+        # Every upload is a new book: one scratch project per run and full set of book codes
+        index = self.uploads
+        self.uploads += 1
+        project_name = f"{self.args.prefix}upload_{self.run_tag}_{index // len(BOOKS)}"
+        async with self.upload_lock:
+            if project_name not in self.upload_projects:
+                await self.client.post("/add_project/", json={"project_name": project_name})
+                self.upload_projects.add(project_name)
+        usfm = synthetic_book(BOOKS[index % len(BOOKS)], self.args.chapters, self.args.verses, index)
+        return await self.client.post("/upload_usfm/", json=upload_payload(project_name, usfm))
+
+    async def withbcv(self):
+        first, second = self.rng.sample(self.projects, 2)
+        return await self.client.get("/parallel_corpora/withbcv/", params={"project_name_1": first, "project_name_2": second})
+
+    async def withoutbcv(self):
+        first, second = self.rng.sample(self.projects, 2)
+        return await self.client.get("/parallel_corpora/withoutbcv/", params={"project_name_1": first, "project_name_2": second})
+
+    async def user(self, weights, warmup_end, deadline):
+        names = list(weights)
+        name_weights = list(weights.values())
+        while time.perf_counter() < deadline:
+            name = self.rng.choices(names, name_weights)[0]
+            start = time.perf_counter()
+            try:
+                status = (await getattr(self, name)()).status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            if start >= warmup_end:
+                self.samples[name].append(elapsed)
+                self.statuses[name][status] = self.statuses[name].get(status, 0) + 1
+
+    async def run(self, weights):
+        start = time.perf_counter()
+        warmup_end = start + self.args.warmup
+        deadline = warmup_end + self.args.duration
+        await asyncio.gather(*(self.user(weights, warmup_end, deadline) for _ in range(self.args.concurrency)))
+        return time.perf_counter() - warmup_end
+
+    def report(self, measured_seconds):
+        results = {}
+        for name, samples in self.samples.items():
+            if not samples:
+                continue
+            samples.sort()
+            statuses = self.statuses[name]
+            results[name] = {
+                "requests": len(samples),
+                "errors": sum(count for status, count in statuses.items() if not isinstance(status, int) or (status >= 400 and status != 429)),
+                "rejected": statuses.get(429, 0),
+                "rps": len(samples) / measured_seconds,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": samples[-1] * 1000,
+                "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+            }
+        return results
+
+
+def print_report(results, measured_seconds, concurrency):
+    header = f"{'endpoint':<12}{'requests':>10}{'errors':>8}{'429':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+    print(f"{concurrency} users for {measured_seconds:.1f}s")
+    print(header)
+    print("-" * len(header))
+    for name, row in results.items():
+        print(
+            f"{name:<12}{row['requests']:>10}{row['errors']:>8}{row['rejected']:>6}{row['rps']:>9.1f}"
+            f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}"
+        )
+    total = sum(row["requests"] for row in results.values())
+    print(f"{'total':<12}{total:>10}{'':>23}{total / measured_seconds:>9.1f}")
+
+
+def cleanup(prefix):
+    """ Remove every load test project from the configured database """
+    import database
+    from db_models import Project
+    from ingest_memory import remove_project
+
+    session = database.SessionLocal()
+    try:
+        names = [name for (name,) in session.query(Project.project_name).filter(Project.project_name.startswith(prefix))]
+        for project_name in names:
+            remove_project(session, project_name)
+        print(f"Removed {len(names)} load test projects")
+    finally:
+        session.close()
+
+
+async def main_async(args):
+    weights = parse_mix(args.mix)
+    if args.base_url:
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=args.concurrency))
+        base_url = args.base_url
+    else:
+        import main
+        transport = httpx.ASGITransport(app=main.app)
+        base_url = "http://load-test"
+
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+        test = LoadTest(client, args)
+        await test.seed()
+        measured_seconds = await test.run(weights)
+    return test.report(measured_seconds), measured_seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive a weighted mix of API requests and report latency percentiles per endpoint")
+    parser.add_argument("--base-url", help="URL of a running server; without it the app runs in process")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent virtual users (default: 16)")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds (default: 30)")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of traffic before measuring (default: 5)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"endpoint weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--projects", type=int, default=2, help="seeded projects to read from, at least 2 (default: 2)")
+    parser.add_argument("--books", type=int, default=5, help="books per seeded project (default: 5)")
+    parser.add_argument("--chapters", type=int, default=20, help="chapters per synthetic book (default: 20)")
+    parser.add_argument("--verses", type=int, default=25, help="verses per chapter (default: 25)")
+    parser.add_argument("--prefix", default="__load_test__", help="name prefix of the seeded and scratch projects")
+    parser.add_argument("--timeout", type=float, default=120, help="per-request timeout in seconds (default: 120)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the request mix")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this JSON file")
+    parser.add_argument("--cleanup", action="store_true", help="remove the load test projects from the configured database afterwards")
+    args = parser.parse_args(argv)
+    args.books = max(1, min(args.books, len(BOOKS)))
+
+    # The app logs every request and stage, and every skipped empty verse row while parsing
+    logging.basicConfig(level=logging.ERROR, force=True)
+    results, measured_seconds = asyncio.run(main_async(args))
+    print_report(results, measured_seconds, args.concurrency)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"concurrency": args.concurrency, "seconds": measured_seconds, "mix": args.mix, "endpoints": results}, f, indent=2)
+    if args.cleanup:
+        cleanup(args.prefix)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
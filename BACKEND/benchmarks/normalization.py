@@ -0,0 +1,162 @@
+"""
+Compare the two normalization modes on the same books, without a database.
+
+- usfm: normalize the whole raw book (markers included), then parse; what NORMALIZATION_MODE=usfm does.
+- text: parse the raw book, then normalize only the text values of the USJ and the text of
+  each extracted verse through the cache; run twice, cold and then warm, the way a second
+  revision of the same book is.
+
+Reports per book the bytes each mode normalizes and the time of normalization and of the
+whole normalize + parse + verse extraction, plus how many verse rows come out identical.
+Rows can differ where punctuation sits next to a character marker: in usfm mode the marker
+separates the punctuation from the word, in text mode the verse is normalized as plain text.
+--differences prints examples. Without files a set of synthetic books with headings,
+footnotes, recurring lines and punctuation around character markers is used.
+
+    python benchmarks/normalization.py path/to/*.usfm
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from usfm_grammar import USFMParser  # noqa: E402
+import crud  # noqa: E402
+
+
+LINES = [
+    "In the beginning was the Word , and the Word was with God ...",
+    "He said, “Let there be light” – and there was light.",
+    "Blessed is the one who does not walk in step with the wicked ; ‘selah’",
+    "The Lord is my shepherd , I lack nothing .",
+    "आदि में वचन था, और वचन परमेश्वर के साथ था।",
+]
+
+
+def synthetic_book(book_name, chapters, verses):
+    """ A book with a recurring section heading, footnotes and refrains, like poetry and gospels have """
+    lines = [f"\\id {book_name} normalization benchmark", "\\h Benchmark", "\\mt1 Benchmark"]
+    for chapter in range(1, chapters + 1):
+        lines += [f"\\c {chapter}", "\\s1 A song of ascents", "\\p"]
+        for verse in range(1, verses + 1):
+            text = LINES[(chapter + verse) % len(LINES)]
+            if verse % 5 == 0:
+                # A refrain, identical wherever it occurs
+                text = "For his steadfast love endures forever ."
+            if verse % 3 == 0:
+                # Punctuation next to character markers, where the two modes can differ
+                text = f"The \\nd LORD\\nd* : said ( \\add to him\\add* ) , “ \\wj Go\\wj* ” ; {text}"
+            if verse % 7 == 0:
+                text += f" \\f + \\fr {chapter}:{verse} \\ft Some manuscripts add “and peace” .\\f*"
+            lines.append(f"\\v {verse} {text} ({book_name} {chapter}:{verse})")
+    return "\n".join(lines) + "\n"
+
+
+def text_bytes(usj_data):
+    """ UTF-8 size of all text values of a USJ document """
+    total = 0
+    stack = [usj_data]
+    while stack:
+        for item in stack.pop().get("content") or ():
+            if isinstance(item, str):
+                total += len(item.encode("utf-8"))
+            else:
+                stack.append(item)
+    return total
+
+
+def verse_rows(usj_data, book_name):
+    return list(crud.valid_verse_rows(book_name, crud.extract_verse_rows(usj_data, book_name)))
+
+
+def run_usfm_mode(usfm, book_name):
+    start = time.perf_counter()
+    normalized = crud.normalize_book_text(usfm)
+    normalize_seconds = time.perf_counter() - start
+    usj_data = USFMParser(normalized).to_usj()
+    rows = verse_rows(usj_data, book_name)
+    return len(usfm.encode("utf-8")), normalize_seconds, time.perf_counter() - start, rows
+
+
+def run_text_mode(usfm, book_name):
+    """ What ingest does in text mode: normalize the USJ text values, then each extracted verse as a whole """
+    start = time.perf_counter()
+    usj_data = USFMParser(usfm).to_usj()
+    parsed = time.perf_counter()
+    normalized_bytes = text_bytes(usj_data)
+    counted = time.perf_counter()
+    crud.normalize_usj_text(usj_data)
+    nodes_done = time.perf_counter()
+    extracted = list(crud.extract_verse_rows(usj_data, book_name))
+    extracted_at = time.perf_counter()
+    extracted = list(crud.normalize_verse_rows(extracted))
+    verses_done = time.perf_counter()
+    rows = list(crud.valid_verse_rows(book_name, extracted))
+    normalize_seconds = (nodes_done - counted) + (verses_done - extracted_at)
+    # The byte count is benchmark bookkeeping, not part of the pipeline
+    total_seconds = time.perf_counter() - start - (counted - parsed)
+    return normalized_bytes, normalize_seconds, total_seconds, rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare whole-USFM and text-only normalization per book")
+    parser.add_argument("files", nargs="*", help="USFM files (default: synthetic books)")
+    parser.add_argument("--books", type=int, default=5, help="synthetic books when no files are given (default: 5)")
+    parser.add_argument("--chapters", type=int, default=50, help="chapters per synthetic book (default: 50)")
+    parser.add_argument("--verses", type=int, default=30, help="verses per synthetic chapter (default: 30)")
+    parser.add_argument("--differences", type=int, default=0, help="print up to this many differing verse rows")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    if args.files:
+        books = []
+        for path in args.files:
+            with open(path, encoding="utf-8") as f:
+                usfm = f.read()
+            books.append((crud.extract_book_code(usfm) or os.path.basename(path), usfm))
+    else:
+        codes = ["PSA", "ISA", "MAT", "LUK", "JHN", "ACT", "ROM", "REV"]
+        books = [(codes[i % len(codes)], synthetic_book(codes[i % len(codes)], args.chapters, args.verses)) for i in range(args.books)]
+
+    crud.text_normalization_cache.clear()
+    header = (
+        f"{'book':<6}{'usfm KB':>9}{'text KB':>9}{'saved':>7}"
+        f"{'norm ms':>9}{'cold ms':>9}{'warm ms':>9}{'total ms':>10}{'cold ms':>9}{'warm ms':>9}{'same rows':>11}"
+    )
+    print(f"{'':<6}{'normalized bytes':^25}{'normalize: usfm/text cold/warm':^27}{'normalize+parse+extract':^28}")
+    print(header)
+    print("-" * len(header))
+    totals = [0.0] * 8
+    differences = []
+    for book_name, usfm in books:
+        usfm_bytes, usfm_norm, usfm_total, usfm_rows = run_usfm_mode(usfm, book_name)
+        text_norm_bytes, cold_norm, cold_total, text_rows = run_text_mode(usfm, book_name)
+        _, warm_norm, warm_total, _ = run_text_mode(usfm, book_name)
+        same = sum(1 for a, b in zip(usfm_rows, text_rows) if a == b)
+        differences += [(book_name, a, b) for a, b in zip(usfm_rows, text_rows) if a != b]
+        values = [usfm_bytes, text_norm_bytes, usfm_norm, cold_norm, warm_norm, usfm_total, cold_total, warm_total]
+        totals = [total + value for total, value in zip(totals, values)]
+        print(
+            f"{book_name:<6}{usfm_bytes / 1024:>9.0f}{text_norm_bytes / 1024:>9.0f}{1 - text_norm_bytes / usfm_bytes:>7.0%}"
+            f"{usfm_norm * 1000:>9.1f}{cold_norm * 1000:>9.1f}{warm_norm * 1000:>9.1f}"
+            f"{usfm_total * 1000:>10.1f}{cold_total * 1000:>9.1f}{warm_total * 1000:>9.1f}"
+            f"{same:>6}/{max(len(usfm_rows), len(text_rows))}"
+        )
+    usfm_bytes, text_norm_bytes, usfm_norm, cold_norm, warm_norm, usfm_total, cold_total, warm_total = totals
+    print(
+        f"{'total':<6}{usfm_bytes / 1024:>9.0f}{text_norm_bytes / 1024:>9.0f}{1 - text_norm_bytes / usfm_bytes:>7.0%}"
+        f"{usfm_norm * 1000:>9.1f}{cold_norm * 1000:>9.1f}{warm_norm * 1000:>9.1f}"
+        f"{usfm_total * 1000:>10.1f}{cold_total * 1000:>9.1f}{warm_total * 1000:>9.1f}"
+    )
+    for book_name, (chapter, verse, usfm_text), (_, _, text_text) in differences[:args.differences]:
+        print(f"{book_name} {chapter}:{verse}\n  usfm: {usfm_text}\n  text: {text_text}")
+    info = crud.text_normalization_cache.info()
+    print(f"cache: {info['hits']} hits, {info['misses']} misses, {info['entries']} entries")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Per-worker memory and restart time of the gunicorn server, with and without preloading.
+
+Starts `gunicorn -c gunicorn_conf.py main:app` from the app folder against the configured
+database (HACKATHON_POSTGRES_* variables), once with GUNICORN_PRELOAD=false and once with
+the default preload. Once every worker has finished its start-up, it reads each worker's
+RSS, PSS (shared pages split between the processes sharing them) and USS (pages only that
+worker holds) from /proc. It then kills one worker and times how long its replacement
+takes to become ready. Linux only; requires gunicorn.
+
+    python benchmarks/worker_memory.py --workers 4
+"""
+import os
+import re
+import sys
+import time
+import queue
+import signal
+import argparse
+import threading
+import subprocess
+
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+# Logged by each uvicorn worker once the lifespan start-up, including main.warm_up, is done
+READY_LINE = re.compile(r"\[(\d+)\] \[INFO\] Application startup complete")
+
+
+def memory_kb(pid):
+    """ RSS, PSS and USS of a process in kB, from /proc/<pid>/smaps_rollup """
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0])
+    return fields["Rss"], fields["Pss"], fields["Private_Clean"] + fields["Private_Dirty"]
+
+
+class Server:
+    def __init__(self, preload, workers, port):
+        env = dict(os.environ, GUNICORN_PRELOAD="true" if preload else "false", WEB_CONCURRENCY=str(workers), GUNICORN_BIND=f"127.0.0.1:{port}")
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn_conf.py", "main:app"],
+            cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        )
+        self.ready = queue.Queue()
+        threading.Thread(target=self._read_log, daemon=True).start()
+
+    def _read_log(self):
+        for line in self.process.stderr:
+            match = READY_LINE.search(line)
+            if match:
+                self.ready.put((int(match.group(1)), time.perf_counter()))
+
+    def wait_ready(self, count, timeout):
+        """ pid -> perf_counter time for the next count workers that report ready """
+        ready = {}
+        deadline = time.perf_counter() + timeout
+        while len(ready) < count:
+            try:
+                pid, at = self.ready.get(timeout=max(deadline - time.perf_counter(), 0.01))
+            except queue.Empty:
+                raise SystemExit(f"Only {len(ready)} of {count} workers became ready within {timeout}s")
+            ready[pid] = at
+        return ready
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def measure(preload, workers, port, timeout):
+    server = Server(preload, workers, port)
+    try:
+        ready = server.wait_ready(workers, timeout)
+        startup = max(ready.values()) - server.started
+        time.sleep(1)
+        master = memory_kb(server.process.pid)
+        per_worker = [memory_kb(pid) for pid in ready]
+
+        killed = next(iter(ready))
+        killed_at = time.perf_counter()
+        os.kill(killed, signal.SIGKILL)
+        (_, replaced_at), = server.wait_ready(1, timeout).items()
+        return startup, master, per_worker, replaced_at - killed_at
+    finally:
+        server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare per-worker memory and restart time with and without preloading")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers (default: 4)")
+    parser.add_argument("--port", type=int, default=8790, help="port for the test server (default: 8790)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for workers to become ready (default: 120)")
+    args = parser.parse_args(argv)
+
+    header = f"{'mode':<10}{'startup s':>10}{'restart s':>10}{'worker RSS MB':>15}{'worker PSS MB':>15}{'worker USS MB':>15}{'total PSS MB':>14}"
+    print(header)
+    print("-" * len(header))
+    for preload in (False, True):
+        startup, master, per_worker, restart = measure(preload, args.workers, args.port, args.timeout)
+        rss, pss, uss = (sum(values[i] for values in per_worker) / len(per_worker) / 1024 for i in range(3))
+        total_pss = (master[1] + sum(values[1] for values in per_worker)) / 1024
+        print(
+            f"{'preload' if preload else 'no preload':<10}{startup:>10.1f}{restart:>10.2f}"
+            f"{rss:>15.0f}{pss:>15.0f}{uss:>15.0f}{total_pss:>14.0f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())